@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Banco de pruebas de carga del servidor HFTP: lanza un server local
+# sobre un directorio temporal y mide rendimiento y latencia.
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import optparse
+import tempfile
+import threading
+import client
+import server
+from constants import *
+
+# Operaciones que puede incluir una mezcla de carga
+OPERATIONS = ["list", "metadata", "slice"]
+# Archivos chicos extra del directorio, para que el listado tenga peso
+LISTING_FILES = 100
+
+
+class NullOutput(object):
+  """
+  Destino de los fragmentos recibidos: se descartan, para no medir el
+  disco del cliente.
+  """
+
+  def write(self, data):
+    pass
+
+
+def percentile(values, q):
+  """
+  Percentil q (entre 0 y 1) de una lista ya ordenada.
+  """
+  if not values:
+    return None
+  return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def server_memory(pid):
+  """
+  Memoria residente actual y máxima del proceso, en KiB, según
+  /proc/<pid>/status. Devuelve (None, None) si no está disponible.
+  """
+  rss = hwm = None
+  try:
+    with open("/proc/%d/status" % pid) as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          rss = int(line.split()[1])
+        elif line.startswith("VmHWM:"):
+          hwm = int(line.split()[1])
+  except OSError:
+    pass
+  return rss, hwm
+
+
+def prepare_data(directory, sizes):
+  """
+  Crea en el directorio un archivo de cada tamaño pedido, más
+  LISTING_FILES archivos vacíos.
+  """
+  for size in sizes:
+    with open(os.path.join(directory, "data_%d" % size), "wb") as f:
+      remaining = size
+      while remaining > 0:
+        block = os.urandom(min(remaining, 2 ** 20))
+        f.write(block)
+        remaining -= len(block)
+  for i in range(LISTING_FILES):
+    open(os.path.join(directory, "empty_%d" % i), "w").close()
+
+
+def start_server(directory, port, mode):
+  """
+  Lanza un server.Server en un proceso hijo y espera a que acepte
+  conexiones. Devuelve el pid del hijo.
+  """
+  pid = os.fork()
+  if pid == 0:
+    # Proceso hijo: el server no vuelve nunca
+    status = 1
+    try:
+      devnull = os.open(os.devnull, os.O_WRONLY)
+      os.dup2(devnull, sys.stdout.fileno())
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      server.Server("127.0.0.1", port, directory).run(mode)
+    except KeyboardInterrupt:
+      status = 0
+    finally:
+      os._exit(status)
+
+  deadline = time.monotonic() + 10
+  while time.monotonic() < deadline:
+    try:
+      socket.create_connection(("127.0.0.1", port), 1).close()
+      return pid
+    except OSError:
+      time.sleep(0.05)
+  stop_server(pid)
+  raise RuntimeError("El server no arrancó en el puerto %d" % port)
+
+
+def stop_server(pid):
+  os.kill(pid, signal.SIGTERM)
+  os.waitpid(pid, 0)
+
+
+def run_operation(c, operation, filename, size):
+  """
+  Ejecuta una operación con el cliente y devuelve los bytes de datos
+  recibidos, o None si el server respondió con un error.
+  """
+  if operation == "list":
+    c.file_lookup()
+    received = 0
+  elif operation == "metadata":
+    c.get_metadata(filename)
+    received = 0
+  else:
+    c.send("get_slice %s 0 %d" % (filename, size))
+    c.status, message = c.read_response_line()
+    received = 0
+    if c.status == CODE_OK:
+      received = c.read_fragment(size, NullOutput())
+  if c.status != CODE_OK:
+    return None
+  return received
+
+
+def run_level(port, size, concurrency, mix, duration):
+  """
+  Corre `concurrency' clientes en paralelo durante `duration' segundos,
+  cada uno eligiendo operaciones al azar según los pesos de `mix'.
+  Devuelve las latencias ordenadas, los bytes recibidos, los errores y
+  el tiempo total.
+  """
+  operations = [operation for operation in OPERATIONS if mix.get(operation)]
+  weights = [mix[operation] for operation in operations]
+  filename = "data_%d" % size
+  lock = threading.Lock()
+  latencies = []
+  totals = {"bytes": 0, "errors": 0}
+  start_barrier = threading.Barrier(concurrency + 1)
+
+  def worker(seed):
+    rng = random.Random(seed)
+    own_latencies = []
+    own_bytes = own_errors = 0
+    try:
+      c = client.Client("127.0.0.1", port)
+    except OSError:
+      start_barrier.wait()
+      with lock:
+        totals["errors"] += 1
+      return
+    start_barrier.wait()
+    deadline = time.monotonic() + duration
+    try:
+      while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        t1 = time.perf_counter()
+        received = run_operation(c, operation, filename, size)
+        own_latencies.append(time.perf_counter() - t1)
+        if received is None or not c.connected:
+          own_errors += 1
+          if not c.connected:
+            break
+        else:
+          own_bytes += received
+      c.close()
+    except OSError:
+      own_errors += 1
+    with lock:
+      latencies.extend(own_latencies)
+      totals["bytes"] += own_bytes
+      totals["errors"] += own_errors
+
+  threads = [threading.Thread(target=worker, args=(i,))
+             for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  start_barrier.wait()
+  started = time.monotonic()
+  for thread in threads:
+    thread.join()
+  elapsed = time.monotonic() - started
+  latencies.sort()
+  return latencies, totals["bytes"], totals["errors"], elapsed
+
+
+def benchmark(modes, sizes, concurrencies, mix, duration, port):
+  """
+  Corre el barrido completo y devuelve una lista de resultados, uno por
+  combinación de modo, tamaño de archivo y concurrencia.
+  """
+  results = []
+  with tempfile.TemporaryDirectory(prefix="hftp-bench-") as directory:
+    prepare_data(directory, sizes)
+    for mode in modes:
+      pid = start_server(directory, port, mode)
+      try:
+        for size in sizes:
+          for concurrency in concurrencies:
+            latencies, received, errors, elapsed = run_level(
+                port, size, concurrency, mix, duration)
+            rss, hwm = server_memory(pid)
+            results.append({
+                "mode": mode,
+                "size": size,
+                "concurrency": concurrency,
+                "mix": format_mix(mix),
+                "requests": len(latencies),
+                "errors": errors,
+                "seconds": round(elapsed, 3),
+                "requests_per_s": round(len(latencies) / elapsed, 1),
+                "mb_per_s": round(received / elapsed / 2 ** 20, 2),
+                "latency_ms": {
+                    name: (None if value is None else round(value * 1000, 3))
+                    for name, value in (
+                        ("p50", percentile(latencies, 0.5)),
+                        ("p99", percentile(latencies, 0.99)),
+                        ("p999", percentile(latencies, 0.999)),
+                        ("max", latencies[-1] if latencies else None))},
+                "server_rss_kb": rss,
+                "server_peak_rss_kb": hwm,
+            })
+            print("%-9s size=%-9d clients=%-4d %9.1f req/s %8.2f MB/s "
+                  "p99=%s ms" % (mode, size, concurrency,
+                                 results[-1]["requests_per_s"],
+                                 results[-1]["mb_per_s"],
+                                 results[-1]["latency_ms"]["p99"]),
+                  file=sys.stderr)
+      finally:
+        stop_server(pid)
+  return results
+
+
+def compare(results, baseline, tolerance):
+  """
+  Compara los resultados con los de una corrida guardada. Devuelve la
+  lista de regresiones: combinaciones cuyo req/s bajó, o cuya latencia
+  p99 subió, más de `tolerance' (fracción).
+  """
+  def key(result):
+    return (result["mode"], result["size"], result["concurrency"],
+            result["mix"])
+
+  previous = {key(result): result for result in baseline}
+  regressions = []
+  for result in results:
+    old = previous.get(key(result))
+    if old is None:
+      continue
+    if result["requests_per_s"] < old["requests_per_s"] * (1 - tolerance):
+      regressions.append({"case": key(result), "metric": "requests_per_s",
+                          "baseline": old["requests_per_s"],
+                          "current": result["requests_per_s"]})
+    old_p99 = old["latency_ms"]["p99"]
+    new_p99 = result["latency_ms"]["p99"]
+    if (old_p99 is not None and new_p99 is not None and
+        new_p99 > old_p99 * (1 + tolerance)):
+      regressions.append({"case": key(result), "metric": "p99_ms",
+                          "baseline": old_p99, "current": new_p99})
+  return regressions
+
+
+def parse_list(value, convert=int):
+  return [convert(item) for item in value.split(",") if item]
+
+
+def parse_mix(value):
+  """
+  Parsea una mezcla de la forma "list=1,metadata=8,slice=1".
+  """
+  mix = {}
+  for item in value.split(","):
+    operation, weight = item.split("=")
+    if operation not in OPERATIONS:
+      raise ValueError("Operación desconocida: %s" % operation)
+    mix[operation] = float(weight)
+  if not any(mix.values()):
+    raise ValueError("La mezcla no tiene operaciones")
+  return mix
+
+
+def format_mix(mix):
+  return ",".join("%s=%g" % (operation, mix[operation])
+                  for operation in OPERATIONS if operation in mix)
+
+
+def main():
+  """Parsea los argumentos y corre el banco de pruebas"""
+
+  parser = optparse.OptionParser()
+  parser.add_option(
+      "-m", "--modes",
+      help="Modos del server a medir, separados por comas",
+      default=",".join(SERVE_MODES))
+  parser.add_option(
+      "-s", "--sizes",
+      help="Tamaños de archivo en bytes, separados por comas",
+      default="1024,1048576")
+  parser.add_option(
+      "-c", "--concurrency",
+      help="Cantidades de clientes en paralelo, separadas por comas",
+      default="1,8,32")
+  parser.add_option(
+      "-x", "--mix",
+      help="Pesos de cada operación (%s)" % ", ".join(OPERATIONS),
+      default="list=1,metadata=8,slice=1")
+  parser.add_option(
+      "-t", "--duration", type="float",
+      help="Segundos de carga por cada combinación", default=5)
+  parser.add_option(
+      "-p", "--port", type="int",
+      help="Puerto TCP del server de prueba", default=DEFAULT_PORT + 1)
+  parser.add_option(
+      "-o", "--output",
+      help="Archivo donde guardar los resultados (JSON)")
+  parser.add_option(
+      "-b", "--baseline",
+      help="Resultados guardados contra los cuales comparar")
+  parser.add_option(
+      "--tolerance", type="float",
+      help="Fracción de empeoramiento aceptada respecto del baseline",
+      default=0.1)
+
+  options, args = parser.parse_args()
+  try:
+    modes = parse_list(options.modes, str)
+    sizes = parse_list(options.sizes)
+    concurrencies = parse_list(options.concurrency)
+    mix = parse_mix(options.mix)
+  except ValueError as e:
+    sys.stderr.write("Argumento inválido: %s\n" % e)
+    parser.print_help()
+    sys.exit(1)
+  if (len(args) > 0 or not set(modes) <= set(SERVE_MODES) or
+      min(concurrencies) < 1):
+    parser.print_help()
+    sys.exit(1)
+
+  results = benchmark(modes, sizes, concurrencies, mix, options.duration,
+                      options.port)
+  report = {"results": results}
+  if options.baseline:
+    with open(options.baseline) as f:
+      baseline = json.load(f)["results"]
+    report["regressions"] = compare(results, baseline, options.tolerance)
+
+  output = json.dumps(report, indent=2)
+  if options.output:
+    with open(options.output, "w") as f:
+      f.write(output + "\n")
+  print(output)
+  if report.get("regressions"):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
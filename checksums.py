@@ -0,0 +1,123 @@
+# encoding: utf-8
+# Índice de hashes por bloque de los archivos servidos, para que un
+# cliente pueda bajar solo los bloques que cambiaron.
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from constants import *
+
+
+def block_digest(data):
+  """
+  Hash de un bloque, en hexadecimal. Lo usan el server y el cliente.
+  """
+  return hashlib.blake2b(data, digest_size=CHECKSUM_DIGEST_SIZE).hexdigest()
+
+
+def file_digests(cached, block_size):
+  """
+  Calcula los hashes de los bloques de un archivo abierto, leyéndolo
+  de a un bloque. Lanza FileShrunk si el archivo se achica mientras.
+  """
+  return [block_digest(block)
+          for block in cached.blocks(0, cached.size, block_size)]
+
+
+def sums_dir(directory):
+  """
+  Directorio donde se guardan los índices del directorio servido: uno
+  hermano, para no aparecer en el listado.
+  """
+  return os.path.abspath(directory) + CHECKSUM_DIR_SUFFIX
+
+
+class ChecksumCache(object):
+  """
+  Hashes por bloque de los archivos servidos. Se calculan recién cuando
+  se piden, se guardan en disco junto al directorio servido y se
+  recuerdan en memoria para los max_files archivos más usados.
+
+  Cada índice lleva la identidad (inodo, fecha de modificación, tamaño)
+  del archivo con el que se calculó: si el archivo cambió, se vuelve a
+  calcular.
+  """
+
+  def __init__(self, block_size=CHECKSUM_BLOCK_SIZE,
+               max_files=CHECKSUM_CACHE_FILES):
+    self.block_size = block_size
+    self.max_files = max_files
+    # path -> (identidad del archivo, hashes)
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def lookup(self, directory, filename, cached):
+    """
+    Devuelve la lista de hashes del archivo abierto si está en memoria,
+    o None si habría que leerla o calcularla.
+    """
+    path = directory + os.path.sep + filename
+    with self.lock:
+      entry = self.entries.get(path)
+      if entry is not None and entry[0] == cached.identity:
+        self.entries.move_to_end(path)
+        return entry[1]
+    return None
+
+  def get(self, directory, filename, cached):
+    """
+    Devuelve la lista de hashes de los bloques del archivo abierto. Si
+    no está en memoria ni en disco, la calcula leyendo el archivo entero.
+    """
+    digests = self.lookup(directory, filename, cached)
+    if digests is not None:
+      return digests
+
+    # Se lee o calcula fuera del lock para no frenar al resto
+    path = directory + os.path.sep + filename
+    sums_path = sums_dir(directory) + os.path.sep + filename
+    digests = self._load(sums_path, cached.identity)
+    if digests is None:
+      digests = file_digests(cached, self.block_size)
+      self._save(sums_path, cached.identity, digests)
+    with self.lock:
+      self.entries[path] = (cached.identity, digests)
+      self.entries.move_to_end(path)
+      while len(self.entries) > self.max_files:
+        self.entries.popitem(last=False)
+    return digests
+
+  def _header(self, identity):
+    return "%d %d %d %d" % (identity + (self.block_size,))
+
+  def _load(self, sums_path, identity):
+    """
+    Lee un índice guardado. Devuelve None si no existe o es de otra
+    versión del archivo.
+    """
+    try:
+      with open(sums_path, 'r', encoding='ascii') as f:
+        lines = f.read().split(NEWLINE)
+    except (OSError, UnicodeError):
+      return None
+    if lines[0] != self._header(identity) or lines[-1] != "":
+      return None
+    return lines[1:-1]
+
+  def _save(self, sums_path, identity, digests):
+    """
+    Guarda un índice, reemplazando el anterior de una sola vez. Si no se
+    puede escribir, el índice solo queda en memoria.
+    """
+    temp_path = "%s.%d.%d" % (sums_path, os.getpid(), threading.get_ident())
+    try:
+      os.makedirs(os.path.dirname(sums_path), exist_ok=True)
+      with open(temp_path, 'w', encoding='ascii') as f:
+        f.write(NEWLINE.join([self._header(identity)] + digests + [""]))
+      os.replace(temp_path, sums_path)
+    except OSError:
+      try:
+        os.unlink(temp_path)
+      except OSError:
+        pass
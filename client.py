@@ -6,28 +6,116 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: client.py 387 2011-03-22 13:48:44Z nicolasw $
 
+import os
 import socket
+import asyncio
+import contextlib
+import functools
 import logging
 import optparse
 import sys
 import time
+import threading
+import zlib
+from collections import deque
 from base64 import b64decode
 from constants import *
+from linebuffer import LineBuffer, EOL_BYTES
+from checksums import block_digest
+
+
+def parse_response(response):
+  """
+  Parsea una línea de respuesta de un comando.
+
+  Devuelve un par (int, str) con el código y el error, o
+  (None, None) en caso de error.
+  """
+  result = None, None
+  if ' ' in response:
+    code, message = response.split(None, 1)
+    try:
+      result = int(code), message
+    except ValueError:
+      pass
+  else:
+    logging.warning("Respuesta inválida: '%s'" % response)
+  return result
+
+
+class OffsetWriter(object):
+  """
+  Escribe lo que recibe en un descriptor a partir de una posición dada,
+  con pwrite, sin mover el offset compartido del archivo. Así varios
+  hilos pueden escribir a la vez partes distintas del mismo archivo.
+  """
+
+  def __init__(self, fd, offset):
+    self.fd = fd
+    self.offset = offset
+
+  def write(self, data):
+    data = memoryview(data)
+    while len(data) > 0:
+      written = os.pwrite(self.fd, data, self.offset)
+      self.offset += written
+      data = data[written:]
+
+
+class DecompressWriter(object):
+  """
+  Descomprime con zlib lo que recibe y lo escribe en `output'.
+  """
+
+  def __init__(self, output):
+    self.output = output
+    self.decompressor = zlib.decompressobj()
+
+  def write(self, data):
+    self.output.write(self.decompressor.decompress(data))
+
+  def finish(self):
+    self.output.write(self.decompressor.flush())
+
+
+@contextlib.contextmanager
+def open_slice_output(filename, start, in_place):
+  """
+  Abre el archivo local donde guardar un trozo que empieza en `start'.
+  Sin in_place, el archivo queda con solo el trozo. Con in_place, el
+  trozo se escribe en su misma posición, sin truncar el archivo.
+  """
+  if in_place:
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+      yield OffsetWriter(fd, start)
+    finally:
+      os.close(fd)
+  else:
+    with open(filename, 'wb') as output:
+      yield output
 
 
 class Client(object):
 
-  def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+  def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT,
+               recv_size=RECV_SIZE):
     """
     Nuevo cliente, conectado al `server' solicitado en el `port' TCP
-    indicado.
+    indicado. `recv_size' es la cantidad de bytes que se piden por vez
+    al socket.
 
     Si falla la conexión, genera una excepción de socket.
     """
+    self.server = server
+    self.port = port
     self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.status = None
     self.s.connect((server, port))
-    self.buffer = ''
+    # Del tamaño de cada lectura, para que los bloques grandes lleguen de a
+    # `recv_size' y no de a lo que ocupa un buffer de líneas
+    self.buffer = LineBuffer(recv_size)
+    self.recv_size = recv_size
     self.connected = True
 
   def close(self):
@@ -61,6 +149,36 @@ class Client(object):
       assert bytes_sent > 0
       message = message[bytes_sent:]
 
+  def is_alive(self):
+    """
+    Responde, sin esperar ni enviar nada, si la conexión sigue abierta y
+    sin datos pendientes: un cliente sano no tiene nada para leer entre
+    comando y comando.
+    """
+    if not self.connected or len(self.buffer) > 0:
+      return False
+    # Con un timeout puesto, MSG_DONTWAIT no alcanza: el socket espera igual
+    timeout = self.s.gettimeout()
+    self.s.settimeout(0)
+    try:
+      data = self.s.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+      return True
+    except socket.error:
+      return False
+    finally:
+      self.s.settimeout(timeout)
+    # Llegó el cierre del server, o datos que nadie pidió
+    return False
+
+  def send_many(self, messages, timeout=None):
+    """
+    Envía varios mensajes juntos, sin esperar las respuestas de los
+    anteriores. Las respuestas llegan en el mismo orden.
+    """
+    self.s.settimeout(timeout)
+    self.s.sendall((EOL.join(messages) + EOL).encode("ascii"))
+
   def _recv(self, timeout=None):
     """
     Recibe datos y acumula en el buffer interno.
@@ -68,10 +186,7 @@ class Client(object):
     Para uso privado del cliente.
     """
     self.s.settimeout(timeout)
-    data = self.s.recv(4096).decode("ascii")
-    self.buffer += data
-
-    if len(data) == 0:
+    if self.buffer.recv_into(self.s, self.recv_size) == 0:
       logging.info("El server interrumpió la conexión.")
       self.connected = False
 
@@ -83,20 +198,26 @@ class Client(object):
     Devuelve la línea, eliminando el terminaodr y los espacios en blanco
     al principio y al final.
     """
-    while EOL not in self.buffer and self.connected:
-      if timeout is not None:
-        t1 = time.process_time()
+    return self.read_raw_line(timeout).decode("ascii").strip()
+
+  def read_raw_line(self, timeout=None):
+    """
+    Igual que read_line, pero devuelve la línea en bytes, sin decodificar
+    ni quitar espacios.
+    """
+    # El plazo es de reloj (monotónico), no de tiempo de CPU
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not self.buffer.has_line() and self.connected:
+      if deadline is not None:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          raise socket.timeout("timed out")
       self._recv(timeout)
-      if timeout is not None:
-        t2 = time.process_time()
-        timeout -= t2 - t1
-        t1 = t2
-    if EOL in self.buffer:
-      response, self.buffer = self.buffer.split(EOL, 1)
-      return response.strip()
-    else:
+    response = self.buffer.take_line()
+    if response is None:
       self.connected = False
-      return ""
+      return b""
+    return response
 
   def read_response_line(self, timeout=None):
     """
@@ -105,32 +226,54 @@ class Client(object):
     Devuelve un par (int, str) con el código y el error, o
     (None, None) en caso de error.
     """
-    result = None, None
-    response = self.read_line(timeout)
-    if ' ' in response:
-      code, message = response.split(None, 1)
-      try:
-        result = int(code), message
-      except ValueError:
-        pass
-    else:
-      logging.warning("Respuesta inválida: '%s'" % response)
-    return result
+    return parse_response(self.read_line(timeout))
 
-  def read_fragment(self, length):
+  def read_fragment(self, length, output):
     """
-    Espera y lee un fragmento de un archivo.
+    Espera un fragmento de `length' bytes codificado en base64 y escribe
+    lo decodificado en el archivo `output' a medida que llega, sin
+    juntar el fragmento entero en memoria.
 
-    Devuelve el contenido del fragmento.
+    Devuelve la cantidad de bytes escritos.
     """
-    # Ahora, esperamos hasta tener la cantidad de datos necesaria
-    data = self.read_line()
-    fragment = b64decode(data)
-    while len(fragment) < length:
-      data = self.read_line()
-      fragment += b64decode(data)
+    # Largo de la codificación, que el server envía en una sola línea
+    remaining = (length + 2) // 3 * 4
+    # Caracteres recibidos que todavía no completan un grupo de 4
+    leftover = b""
+    written = 0
+    while remaining > 0 and self.connected:
+      if len(self.buffer) == 0:
+        self._recv()
+        continue
+      data = leftover + self.buffer.take(remaining)
+      remaining -= len(data) - len(leftover)
+      usable = len(data) - len(data) % 4
+      leftover = data[usable:]
+      fragment = b64decode(data[:usable])
+      output.write(fragment)
+      written += len(fragment)
+    # Fin de la línea del fragmento
+    if self.read_raw_line() != b"":
+      logging.warning("El fragmento recibido es más largo de lo esperado.")
+      self.connected = False
+    return written
 
-    return fragment
+  def read_raw(self, length, output):
+    """
+    Espera exactamente `length' bytes crudos y los escribe en el archivo
+    `output' a medida que llegan.
+    """
+    data = self.buffer.take(length)
+    output.write(data)
+    length -= len(data)
+    while length > 0:
+      data = self.s.recv(min(length, RAW_RECV_SIZE))
+      if len(data) == 0:
+        logging.info("El server interrumpió la conexión.")
+        self.connected = False
+        break
+      output.write(data)
+      length -= len(data)
 
   def file_lookup(self):
     """
@@ -152,43 +295,597 @@ class Client(object):
 
     return result
 
+  def file_lookup_metadata(self):
+    """
+    Obtiene en un solo pedido el listado de archivos en el server junto
+    con sus metadatos. Devuelve una lista de ternas (nombre, tamaño,
+    fecha de modificación en nanosegundos).
+    """
+    result = []
+    self.send('get_listing_metadata')
+    self.status, message = self.read_response_line()
+    if self.status == CODE_OK:
+      line = self.read_line()
+      while line:
+        filename, size, mtime = line.rsplit(' ', 2)
+        result.append((filename, int(size), int(mtime)))
+        line = self.read_line()
+    else:
+      logging.warning("Falló la solicitud de la lista de archivos" +
+                      "(code=%s %s)." % (self.status, message))
+    return result
+
+  def get_sizes(self, filenames):
+    """
+    Obtiene en un solo pedido los tamaños de varios archivos. Devuelve
+    una lista con el tamaño de cada uno, o None para los que no existen,
+    o None si falló el pedido.
+    """
+    filenames = list(filenames)
+    self.send('get_sizes %s' % ' '.join(filenames))
+    self.status, message = self.read_response_line()
+    if self.status == CODE_OK:
+      sizes = [int(self.read_line()) for _ in filenames]
+      return [size if size >= 0 else None for size in sizes]
+
   def get_metadata(self, filename):
     """
     Obtiene en el server el tamaño del archivo con el nombre dado.
     Devuelve None en caso de error.
     """
     self.send('get_metadata %s' % filename)
+    return self.read_metadata()
+
+  def read_metadata(self):
+    """
+    Lee la respuesta de un get_metadata. Devuelve el tamaño, o None en
+    caso de error.
+    """
     self.status, message = self.read_response_line()
     if self.status == CODE_OK:
       size = int(self.read_line())
       return size
 
-  def get_slice(self, filename, start, length):
+  def get_metadata_many(self, filenames, window=PIPELINE_WINDOW):
+    """
+    Obtiene los tamaños de varios archivos, enviando los pedidos sin
+    esperar cada respuesta: se mantienen hasta `window' pedidos en vuelo,
+    así ni el cliente ni el server se traban esperando que el otro lea.
+
+    Devuelve una lista con el tamaño de cada archivo, o None para los que
+    dieron error. En self.status queda el código de la última respuesta.
+    """
+    filenames = list(filenames)
+    sizes = []
+    sent = 0
+    while len(sizes) < len(filenames):
+      # Se completa la ventana de a tandas, cuando quedó a la mitad
+      if sent < len(filenames) and sent - len(sizes) <= window // 2:
+        batch = filenames[sent:len(sizes) + window]
+        if self.connected:
+          self.send_many(['get_metadata %s' % name for name in batch])
+        sent += len(batch)
+      sizes.append(self.read_metadata())
+    return sizes
+
+  def get_slice(self, filename, start, length, in_place=False):
     """
     Obtiene un trozo de un archivo en el server.
 
     El archivo es guardado localmente, en el directorio actual, con el
-    mismo nombre que tiene en el server.
+    mismo nombre que tiene en el server. Los datos se escriben a medida
+    que llegan.
+
+    Sin in_place, el archivo local queda con solo el trozo pedido. Con
+    in_place, el trozo se escribe en su misma posición del archivo
+    local, sin truncarlo.
     """
     self.send('get_slice %s %d %d' % (filename, start, length))
     self.status, message = self.read_response_line()
     if self.status == CODE_OK:
-      output = open(filename, 'wb')
-      fragment = self.read_fragment(length)
-      output.write(fragment)
-      output.close()
+      with open_slice_output(filename, start, in_place) as output:
+        written = self.read_fragment(length, output)
+      if written < length:
+        logging.warning("Se recibieron %d de %d bytes de %s."
+                        % (written, length, filename))
     else:
       logging.warning("El servidor indico un error al leer de %s."
                       % filename)
 
-  def retrieve(self, filename):
+  def get_slice_raw(self, filename, start, length):
     """
-    Obtiene un archivo completo desde el servidor.
+    Igual que get_slice, pero el server envía los bytes del archivo sin
+    codificar en base64.
     """
+    self.send('get_slice_raw %s %d %d' % (filename, start, length))
+    self.status, message = self.read_response_line()
+    if self.status == CODE_OK:
+      with open(filename, 'wb') as output:
+        self.read_raw(length, output)
+    else:
+      logging.warning("El servidor indico un error al leer de %s."
+                      % filename)
+
+  def get_slice_zlib(self, filename, start, length, level=None,
+                     in_place=False):
+    """
+    Igual que get_slice, pero el server comprime el trozo con zlib, con
+    el nivel dado o el suyo por omisión, y se descomprime a medida que
+    llega. Si los datos no se comprimen bien, el server los envía sin
+    comprimir.
+    """
+    command = 'get_slice_zlib %s %d %d' % (filename, start, length)
+    if level is not None:
+      command += ' %d' % level
+    self.send(command)
+    self.status, message = self.read_response_line()
+    if self.status == CODE_OK:
+      encoding = self.read_line()
+      with open_slice_output(filename, start, in_place) as output:
+        if encoding == 'raw':
+          self.read_raw(length, output)
+        else:
+          self.read_compressed(output)
+    else:
+      logging.warning("El servidor indico un error al leer de %s."
+                      % filename)
+
+  def read_compressed(self, output):
+    """
+    Lee los bloques comprimidos de una respuesta de get_slice_zlib y
+    escribe lo descomprimido en `output' a medida que llega.
+    """
+    writer = DecompressWriter(output)
+    line = self.read_line()
+    while line.isdigit() and int(line) > 0 and self.connected:
+      self.read_raw(int(line), writer)
+      line = self.read_line()
+    writer.finish()
+
+  def get_range(self, filename, start, length, fd):
+    """
+    Obtiene un trozo de un archivo con get_slice_raw y lo escribe en el
+    descriptor `fd' en la misma posición que tiene en el server.
+    Devuelve True si el trozo llegó completo.
+    """
+    self.send('get_slice_raw %s %d %d' % (filename, start, length))
+    self.status, message = self.read_response_line()
+    if self.status != CODE_OK:
+      return False
+    output = OffsetWriter(fd, start)
+    self.read_raw(length, output)
+    return output.offset == start + length
+
+  def retrieve(self, filename, connections=1, range_size=RANGE_SIZE,
+               retries=RANGE_RETRIES, resume=False, compress=None):
+    """
+    Obtiene un archivo completo desde el servidor. Con más de una
+    conexión, el archivo se baja por partes en paralelo.
+
+    Con resume, si ya hay una copia local parcial (más chica que la del
+    server), se pide solo la parte que le falta. Con compress, el
+    archivo se pide comprimido con ese nivel, por una sola conexión.
+    """
+    get_slice = self.get_slice
+    if compress is not None:
+      connections = 1
+      get_slice = functools.partial(self.get_slice_zlib, level=compress)
     size = self.get_metadata(filename)
     if self.status == CODE_OK:
       assert size >= 0
-      self.get_slice(filename, 0, size)
+      local_size = None
+      if resume and os.path.isfile(filename):
+        local_size = os.path.getsize(filename)
+      if local_size is not None and local_size <= size:
+        logging.info("Se continúa la descarga de %s desde el byte %d."
+                     % (filename, local_size))
+        get_slice(filename, local_size, size - local_size, in_place=True)
+      elif connections > 1 and size > range_size:
+        self.retrieve_parallel(filename, size, connections, range_size,
+                               retries)
+      else:
+        get_slice(filename, 0, size)
+    elif self.status == FILE_NOT_FOUND:
+      logging.info("El archivo solicitado no existe.")
+    else:
+      logging.warning("No se pudo obtener el archivo %s (code=%s)."
+                      % (filename, self.status))
+
+  def get_checksums(self, filename):
+    """
+    Obtiene los hashes por bloque de un archivo en el server. Devuelve
+    una terna (tamaño del archivo, tamaño de bloque, lista de hashes), o
+    None en caso de error.
+    """
+    self.send('get_checksums %s' % filename)
+    self.status, message = self.read_response_line()
+    if self.status == CODE_OK:
+      size, block_size = map(int, self.read_line().split())
+      digests = []
+      digest = self.read_line()
+      while digest:
+        digests.append(digest)
+        digest = self.read_line()
+      return size, block_size, digests
+
+  def sync(self, filename):
+    """
+    Actualiza la copia local de un archivo pidiendo solo los bloques
+    cuyo hash difiere del que informa el server; los bloques
+    consecutivos se piden juntos. Si no hay copia local, se baja todo.
+
+    Devuelve la cantidad de bytes pedidos al server.
+    """
+    checksums = self.get_checksums(filename)
+    if checksums is None:
+      logging.warning("No se pudo obtener el índice de %s (code=%s)."
+                      % (filename, self.status))
+      return 0
+    size, block_size, digests = checksums
+
+    # Rangos [inicio, fin) de bloques que cambiaron
+    ranges = []
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+      for i, digest in enumerate(digests):
+        start = i * block_size
+        end = min(start + block_size, size)
+        if block_digest(os.pread(fd, end - start, start)) == digest:
+          continue
+        if ranges and ranges[-1][1] == start:
+          ranges[-1][1] = end
+        else:
+          ranges.append([start, end])
+      os.ftruncate(fd, size)
+    finally:
+      os.close(fd)
+
+    fetched = 0
+    for start, end in ranges:
+      self.get_slice(filename, start, end - start, in_place=True)
+      if self.status != CODE_OK:
+        break
+      fetched += end - start
+    return fetched
+
+  def retrieve_parallel(self, filename, size, connections,
+                        range_size=RANGE_SIZE, retries=RANGE_RETRIES):
+    """
+    Baja un archivo de `size' bytes dividido en trozos de `range_size',
+    repartidos entre `connections' conexiones nuevas al mismo server.
+    Cada trozo se escribe en su posición apenas llega. Un trozo que
+    falla se vuelve a pedir, por una conexión nueva, hasta `retries'
+    veces.
+
+    Los trozos llegan en cualquier orden, así que la descarga se hace
+    en un archivo aparte, que reemplaza al pedido recién al terminar. Si
+    falla, se conserva solo el principio que llegó sin huecos, para que
+    se pueda continuar con resume.
+
+    Deja en self.status CODE_OK si el archivo llegó completo.
+    """
+    ranges = deque((start, min(range_size, size - start), 0)
+                   for start in range(0, size, range_size))
+    lock = threading.Lock()
+    failed = []
+    # Comienzos de los trozos ya escritos
+    done = set()
+
+    def worker():
+      client = None
+      while True:
+        with lock:
+          if not ranges or failed:
+            break
+          start, length, attempts = ranges.popleft()
+        try:
+          if client is None:
+            client = Client(self.server, self.port, self.recv_size)
+          ok = client.get_range(filename, start, length, fd)
+          status = client.status
+        except socket.error as e:
+          logging.info("Falló el trozo %d+%d de %s: %s"
+                       % (start, length, filename, e))
+          ok, status = False, None
+        if ok:
+          with lock:
+            done.add(start)
+          continue
+        # El estado de la conexión es incierto: se descarta
+        if client is not None:
+          client.s.close()
+          client = None
+        with lock:
+          if attempts < retries and status in (CODE_OK, None):
+            ranges.append((start, length, attempts + 1))
+          else:
+            failed.append(None if status == CODE_OK else status)
+      if client is not None:
+        try:
+          client.close()
+        except socket.error:
+          pass
+
+    partial_name = filename + PARTIAL_SUFFIX
+    fd = os.open(partial_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+      threads = [threading.Thread(target=worker)
+                 for _ in range(min(connections, len(ranges)))]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      if failed:
+        # Lo que sigue al primer trozo que falta puede tener huecos
+        complete = 0
+        while complete in done:
+          complete = min(complete + range_size, size)
+        os.ftruncate(fd, complete)
+    finally:
+      os.close(fd)
+    os.replace(partial_name, filename)
+
+    if failed:
+      self.status = failed[0]
+      logging.warning("No se pudo obtener el archivo %s (code=%s)."
+                      % (filename, self.status))
+    else:
+      self.status = CODE_OK
+
+
+class ClientPool(object):
+  """
+  Conexiones abiertas a servidores HFTP para reutilizar entre
+  operaciones, sin pagar una conexión nueva por cada archivo.
+
+  Se puede usar desde varios hilos: cada conexión se presta a un solo
+  llamador por vez. Las conexiones se abren recién cuando hacen falta,
+  y las que el server cerró mientras esperaban se descartan al
+  prestarlas. Se guardan hasta max_idle libres por servidor.
+  """
+
+  def __init__(self, max_idle=POOL_MAX_IDLE, recv_size=RECV_SIZE):
+    self.max_idle = max_idle
+    self.recv_size = recv_size
+    # (server, port) -> clientes libres, el último usado al final
+    self.idle = {}
+    self.lock = threading.Lock()
+
+  def acquire(self, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+    """
+    Presta una conexión al server, reutilizando una libre si sigue
+    sana o abriendo una nueva. Si falla la conexión, genera una
+    excepción de socket.
+    """
+    while True:
+      with self.lock:
+        clients = self.idle.get((server, port))
+        client = clients.pop() if clients else None
+      if client is None:
+        return Client(server, port, self.recv_size)
+      if client.is_alive():
+        return client
+      logging.info("Se descarta una conexión cerrada a %s:%d."
+                   % (server, port))
+      client.connected = False
+      client.s.close()
+
+  def release(self, client):
+    """
+    Devuelve una conexión prestada. Si quedó en un estado incierto, o
+    ya sobran conexiones libres, se cierra.
+    """
+    if not client.connected or len(client.buffer) > 0:
+      client.connected = False
+      client.s.close()
+      return
+    with self.lock:
+      clients = self.idle.setdefault((client.server, client.port), [])
+      if len(clients) < self.max_idle:
+        clients.append(client)
+        return
+    self._close(client)
+
+  @contextlib.contextmanager
+  def connection(self, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+    """
+    Presta una conexión durante un bloque with. Si el bloque termina
+    con una excepción, la conexión no se reutiliza.
+    """
+    client = self.acquire(server, port)
+    try:
+      yield client
+    except BaseException:
+      client.connected = False
+      raise
+    finally:
+      self.release(client)
+
+  def close(self):
+    """
+    Cierra todas las conexiones libres.
+    """
+    with self.lock:
+      idle = [client for clients in self.idle.values() for client in clients]
+      self.idle.clear()
+    for client in idle:
+      self._close(client)
+
+  def _close(self, client):
+    try:
+      client.close()
+    except socket.error:
+      client.s.close()
+
+
+class AsyncClient(object):
+  """
+  Cliente HFTP sobre streams de asyncio, con los mismos comandos que
+  Client pero como corrutinas. Así un único event loop puede manejar
+  muchas sesiones con uno o varios servers.
+
+  Los comandos de una misma sesión se atienden de a uno por vez, aunque
+  los pidan varias tareas a la vez.
+  """
+
+  def __init__(self, reader: asyncio.StreamReader,
+               writer: asyncio.StreamWriter):
+    """
+    Nuevo cliente sobre una conexión ya abierta; ver connect().
+    """
+    self.reader = reader
+    self.writer = writer
+    self.status = None
+    self.connected = True
+    self.lock = asyncio.Lock()
+
+  @classmethod
+  async def connect(cls, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+    """
+    Abre una conexión con el `server' en el `port' TCP indicado.
+
+    Si falla la conexión, genera una excepción de socket.
+    """
+    reader, writer = await asyncio.open_connection(server, port)
+    return cls(reader, writer)
+
+  async def close(self):
+    """
+    Desconecta al cliente del server, mandando el mensaje apropiado
+    antes de desconectar.
+    """
+    async with self.lock:
+      await self.send('quit')
+      self.status, message = await self.read_response_line()
+    if self.status != CODE_OK:
+      logging.warning("Warning: quit no contesto ok, sino '%s'(%s)'."
+                      % (message, self.status))
+    self.connected = False
+    self.writer.close()
+    try:
+      await self.writer.wait_closed()
+    except ConnectionError:
+      pass
+
+  async def send(self, message):
+    """
+    Envía el mensaje 'message' al server, seguido por el terminador de
+    línea del protocolo.
+    """
+    self.writer.write((message + EOL).encode("ascii"))
+    await self.writer.drain()
+
+  async def read_raw_line(self):
+    """
+    Espera una línea completa y la devuelve en bytes, sin el terminador.
+    """
+    try:
+      line = await self.reader.readuntil(EOL_BYTES)
+    except asyncio.IncompleteReadError:
+      logging.info("El server interrumpió la conexión.")
+      self.connected = False
+      return b""
+    return line[:-len(EOL_BYTES)]
+
+  async def read_line(self):
+    """
+    Igual que Client.read_line.
+    """
+    return (await self.read_raw_line()).decode("ascii").strip()
+
+  async def read_response_line(self):
+    """
+    Igual que Client.read_response_line.
+    """
+    return parse_response(await self.read_line())
+
+  async def read_fragment(self, length, output):
+    """
+    Igual que Client.read_fragment: decodifica el fragmento en base64 de
+    a bloques y los escribe en `output' a medida que llegan.
+    """
+    remaining = (length + 2) // 3 * 4
+    written = 0
+    try:
+      while remaining > 0:
+        # Bloques de largo múltiplo de 4, que se decodifican solos
+        data = await self.reader.readexactly(min(remaining, RECV_SIZE))
+        remaining -= len(data)
+        fragment = b64decode(data)
+        output.write(fragment)
+        written += len(fragment)
+    except asyncio.IncompleteReadError:
+      logging.info("El server interrumpió la conexión.")
+      self.connected = False
+      return written
+    if await self.read_raw_line() != b"":
+      logging.warning("El fragmento recibido es más largo de lo esperado.")
+      self.connected = False
+    return written
+
+  async def file_lookup(self):
+    """
+    Obtener el listado de archivos en el server. Devuelve una lista
+    de strings.
+    """
+    result = []
+    async with self.lock:
+      await self.send('get_file_listing')
+      self.status, message = await self.read_response_line()
+      if self.status == CODE_OK:
+        filename = await self.read_line()
+        while filename:
+          result.append(filename)
+          filename = await self.read_line()
+      else:
+        logging.warning("Falló la solicitud de la lista de archivos" +
+                        "(code=%s %s)." % (self.status, message))
+    return result
+
+  async def get_metadata(self, filename):
+    """
+    Obtiene en el server el tamaño del archivo con el nombre dado.
+    Devuelve None en caso de error.
+    """
+    async with self.lock:
+      await self.send('get_metadata %s' % filename)
+      self.status, message = await self.read_response_line()
+      if self.status == CODE_OK:
+        return int(await self.read_line())
+
+  async def get_slice(self, filename, start, length, in_place=False):
+    """
+    Igual que Client.get_slice. La escritura en disco se hace desde el
+    event loop, ya que es local y en bloques chicos.
+    """
+    async with self.lock:
+      await self.send('get_slice %s %d %d' % (filename, start, length))
+      self.status, message = await self.read_response_line()
+      if self.status != CODE_OK:
+        logging.warning("El servidor indico un error al leer de %s."
+                        % filename)
+        return
+      with open_slice_output(filename, start, in_place) as output:
+        written = await self.read_fragment(length, output)
+    if written < length:
+      logging.warning("Se recibieron %d de %d bytes de %s."
+                      % (written, length, filename))
+
+  async def retrieve(self, filename, resume=False):
+    """
+    Igual que Client.retrieve, sobre una sola conexión.
+    """
+    size = await self.get_metadata(filename)
+    if self.status == CODE_OK:
+      assert size >= 0
+      local_size = None
+      if resume and os.path.isfile(filename):
+        local_size = os.path.getsize(filename)
+      if local_size is not None and local_size <= size:
+        await self.get_slice(filename, local_size, size - local_size,
+                             in_place=True)
+      else:
+        await self.get_slice(filename, 0, size)
     elif self.status == FILE_NOT_FOUND:
       logging.info("El archivo solicitado no existe.")
     else:
@@ -214,6 +911,24 @@ def main():
       "--port",
       help="Numero de puerto TCP donde escuchar",
       default=DEFAULT_PORT)
+  parser.add_option(
+      "-c",
+      "--connections",
+      type="int",
+      help="Conexiones en paralelo para bajar el archivo",
+      default=1)
+  parser.add_option(
+      "-r",
+      "--resume",
+      action="store_true",
+      help="Continuar la descarga de un archivo bajado en parte",
+      default=False)
+  parser.add_option(
+      "-z",
+      "--compress",
+      type="int",
+      help="Pedir el archivo comprimido con zlib, con este nivel (0 a 9)",
+      default=None)
   parser.add_option(
       "-v",
       "--verbose",
@@ -256,7 +971,8 @@ def main():
 
   if client.status == CODE_OK:
     print("* Indique el nombre del archivo a descargar:")
-    client.retrieve(input().strip())
+    client.retrieve(input().strip(), options.connections,
+                    resume=options.resume, compress=options.compress)
 
   client.close()
 
@@ -4,10 +4,187 @@
 # $Id: connection.py 455 2011-05-01 00:32:09Z carlos $
 
 import socket
+import asyncio
+import selectors
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b64encode
 import os
+import zlib
 import time
+import threading
 from constants import *
+from filecache import FileCache, CachedFile, FileShrunk, ResponseCache
+from linebuffer import LineBuffer
+from checksums import ChecksumCache
+from metrics import Metrics
+from shaping import Shaper
+import dirindex
+
+# Archivos abiertos, compartidos por todas las conexiones
+file_cache = FileCache()
+# Respuestas de get_slice ya codificadas, para los fragmentos más pedidos
+response_cache = ResponseCache()
+# Hashes por bloque de los archivos, para get_checksums
+checksum_cache = ChecksumCache()
+# Métricas de todas las conexiones, para el comando stats
+metrics = Metrics()
+for _name in ('hits', 'misses', 'entries', 'bytes'):
+  metrics.register_gauge(
+      'response_cache_' + _name,
+      lambda name=_name: response_cache.stats()[name])
+metrics.register_gauge('file_cache_open_files',
+                       lambda: len(file_cache.entries))
+# Límites de ancho de banda de las descargas; los configura el servidor
+shaper = Shaper()
+# Hilos para las respuestas que no deben frenar al event loop ni al reactor
+background = ThreadPoolExecutor(BACKGROUND_WORKERS,
+                                thread_name_prefix="hftp-background")
+
+
+# Buffers que acepta una sola llamada a sendmsg
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+# Avisa al kernel que sigue más respuesta (similar a TCP_CORK)
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+
+def advance_buffers(buffers, first, bytes_sent):
+  """
+  Descuenta `bytes_sent' bytes enviados de buffers[first:], recortando el
+  último si se envió a medias. Devuelve el índice del primero pendiente.
+  """
+  while bytes_sent > 0:
+    size = len(buffers[first])
+    if bytes_sent < size:
+      buffers[first] = buffers[first][bytes_sent:]
+      break
+    bytes_sent -= size
+    first += 1
+  return first
+
+
+def b64_length(size):
+  """
+  Largo de la codificación en base64 de `size' bytes.
+  """
+  return (size + 2) // 3 * 4
+
+
+class FileSlice(object):
+  """
+  Fragmento de un archivo pendiente de enviar tal cual con sendfile.
+  Lleva la cuenta de lo que falta enviar para los envíos parciales.
+  """
+
+  def __init__(self, cached: CachedFile, offset, size):
+    # Mantiene vivo el archivo del caché mientras dure el envío
+    self.cached = cached
+    self.file = cached.file
+    self.offset = offset
+    self.size = size
+
+  def send(self, nsocket: socket, limit=None):
+    """
+    Envía lo que el socket acepte sin bloquear, hasta `limit' bytes, y
+    devuelve la cantidad de bytes enviados; 0 si el archivo terminó
+    antes de lo esperado.
+    """
+    size = self.size if limit is None else min(self.size, limit)
+    bytes_sent = os.sendfile(
+        nsocket.fileno(), self.file.fileno(), self.offset, size)
+    self.offset += bytes_sent
+    self.size -= bytes_sent
+    return bytes_sent
+
+
+class BulkStream(object):
+  """
+  Bloques de una descarga, que a diferencia del resto de las respuestas
+  pasan por los límites de ancho de banda.
+  """
+
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return next(self.chunks)
+
+
+class Deferred(object):
+  """
+  Respuesta que se calcula con `work' en un hilo de background, y que
+  mientras tanto demora a las que le siguen en la cola de salida.
+  """
+
+  def __init__(self, work):
+    self.work = work
+    self.future = None
+
+
+class Reaper(object):
+  """
+  Vigila los plazos de las conexiones y cierra las vencidas, para que un
+  cliente ocioso o que no avanza no retenga un hilo o una conexión.
+
+  Cada conexión registrada anota en `deadline' el momento (monotónico)
+  en que vence lo que espera del cliente, o None si no espera nada.
+  """
+
+  def __init__(self, idle_timeout=IDLE_TIMEOUT,
+               command_timeout=COMMAND_TIMEOUT, interval=REAPER_INTERVAL):
+    self.idle_timeout = idle_timeout
+    self.command_timeout = command_timeout
+    self.interval = interval
+    self.connections = set()
+    # Conexiones cerradas por vencidas desde el arranque
+    self.reaped = 0
+    self.lock = threading.Lock()
+
+  def add(self, connection):
+    connection.reaper = self
+    with self.lock:
+      self.connections.add(connection)
+
+  def remove(self, connection):
+    """
+    Deja de vigilar una conexión. Debe llamarse antes de cerrar su
+    socket, para no cortar otro que reutilice el descriptor.
+    """
+    with self.lock:
+      self.connections.discard(connection)
+
+  def reap(self):
+    """
+    Da por vencidas las conexiones cuyo plazo pasó y las devuelve.
+    """
+    now = time.monotonic()
+    expired = []
+    with self.lock:
+      for connection in self.connections:
+        deadline = connection.deadline
+        if deadline is not None and deadline <= now:
+          connection.expire()
+          expired.append(connection)
+      for connection in expired:
+        self.connections.discard(connection)
+      self.reaped += len(expired)
+    return expired
+
+  def start(self):
+    """
+    Revisa los plazos cada `interval' segundos en un hilo aparte.
+    """
+    def loop():
+      while True:
+        time.sleep(self.interval)
+        self.reap()
+
+    thr = threading.Thread(target=loop, name="hftp-reaper")
+    thr.daemon = True
+    thr.start()
 
 
 class Connection(object):
@@ -23,37 +200,96 @@ class Connection(object):
     """
     self.socket = nsocket
     self.dir = directory
+    # Índice de archivos del directorio, compartido con otras conexiones
+    self.index = dirindex.get_index(directory)
     self.status = CODE_OK
-    self.buffer = ''
+    # Comando en curso, al que se atribuyen las métricas
+    self.command = NO_COMMAND
+    self.buffer = LineBuffer()
+    # Respuesta encolada, pendiente de enviar con un único sendmsg
+    self.pending = []
+    self.pending_bytes = 0
     self.connected = True
+    # Plazo de lo que se espera del cliente, vigilado por el Reaper
+    self.reaper = None
+    self.deadline = None
+    # Si ya llegó parte de un pedido y corre su plazo
+    self.partial = False
+    self.expired = False
+    # Balde propio de ancho de banda, si hay límite por conexión
+    self.bucket = shaper.connection_bucket()
 
     self.switch_table = {
         COMMANDS[0]: self.get_file_listing,
         COMMANDS[1]: self.get_metadata,
         COMMANDS[2]: self.get_slice,
         COMMANDS[3]: self.quit,
+        COMMANDS[4]: self.get_slice_raw,
+        COMMANDS[5]: self.get_listing_metadata,
+        COMMANDS[6]: self.get_sizes,
+        COMMANDS[7]: self.get_slice_zlib,
+        COMMANDS[8]: self.get_checksums,
+        COMMANDS[9]: self.stats,
     }
 
   # FUNCIONES AUXILIARES
 
   # Lectura de comandos recibidos
-  def _recv(self, timeout=CMD_TIMEOUT):
+  def _recv(self):
     """
     Recibe datos y acumula en el buffer interno.
     """
-    try:
-      self.socket.settimeout(timeout)
-      data = self.socket.recv(4096).decode("ascii")
-      self.buffer += data
+    if self.buffer.recv_into(self.socket) == 0:
+      self.disconnected()
 
-      if len(data) == 0:
-        self.connected = False
-        self.status = BAD_REQUEST
+  def feed(self, data: bytes):
+    """
+    Agrega al buffer interno los datos recibidos del cliente.
+    Un bloque vacío indica que el cliente cerró la conexión.
+    """
+    if len(data) == 0:
+      self.disconnected()
+    else:
+      self.buffer.feed(data)
 
-    except UnicodeError:
-      self.status = BAD_REQUEST
+  def disconnected(self):
+    """
+    Registra que el cliente cerró la conexión.
+    """
+    self.connected = False
+    self.status = BAD_REQUEST
+
+  def update_deadline(self, sending=False):
+    """
+    Renueva el plazo según lo que se espera del cliente: que acepte la
+    próxima parte de la respuesta (sending), que complete el pedido que
+    empezó a enviar, o que envíe uno nuevo.
+    """
+    if self.reaper is None:
+      return
+    now = time.monotonic()
+    if sending:
+      self.deadline = now + self.reaper.command_timeout
+    elif len(self.buffer) == 0:
+      self.partial = False
+      self.deadline = now + self.reaper.idle_timeout
+    elif not self.partial:
+      # El plazo del pedido corre desde que llegó su primer byte
+      self.partial = True
+      self.deadline = now + self.reaper.command_timeout
+
+  def expire(self):
+    """
+    Cierra la conexión por vencida: el hilo que la atiende deja de
+    esperar al cliente y termina.
+    """
+    self.expired = True
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
 
-  def read_line(self, timeout=CMD_TIMEOUT):
+  def read_line(self):
     """
     Espera datos hasta obtener una línea completa delimitada por el
     terminador del protocolo.
@@ -61,24 +297,34 @@ class Connection(object):
     Devuelve la línea, eliminando el terminador y los espacios en blanco
     al principio y al final.
     """
+    while not self.buffer.has_line() and self.status == CODE_OK:
+      self.update_deadline()
+      self._recv()
+    # Mientras se atiende el pedido no se espera nada del cliente
+    self.deadline = None
+
+    return self.take_line()
+
+  def take_line(self):
+    """
+    Extrae del buffer interno la primera línea, que debe estar completa.
+    Si no lo está, o contiene un fin de línea inválido, marca BAD_EOL.
+    Si no es ASCII, marca BAD_REQUEST.
+    """
     ret = ""
-    while EOL not in self.buffer and self.status == CODE_OK:
-      if timeout is not None:
-        time1 = time.process_time()
-      self._recv(timeout)
-      if timeout is not None:
-        time2 = time.process_time()
-        timeout -= time2 - time1
-        time1 = time2
-
-    if EOL in self.buffer:
-      response, self.buffer = self.buffer.split(EOL, 1)
-      ret = response.strip()
+    self.partial = False
+    response = self.buffer.take_line()
+    if response is None:
+      self.status = BAD_EOL
+    else:
+      try:
+        ret = response.decode("ascii").strip()
+      except UnicodeError:
+        self.status = BAD_REQUEST
+        return ""
       if NEWLINE in ret:
         self.status = BAD_EOL
         ret = ""
-    else:
-      self.status = BAD_EOL
     return ret
 
   # Envío de respuestas al cliente
@@ -97,18 +343,158 @@ class Connection(object):
         message = message.encode('ascii')
       else:
         message = b64encode(message)
-      while len(message) > 0:
-        bytes_sent = self.socket.send(message)
+      self.write(message)
+
+  def write(self, data: bytes):
+    """
+    Envía bytes al cliente, contándolos en las métricas del comando.
+    """
+    metrics.add_bytes_out(self.command, len(data))
+    self._write(data)
+
+  def write_stream(self, chunks, bulk=False):
+    """
+    Envía en orden los bloques de un iterable, que se generan recién
+    cuando hace falta enviarlos. Los de una descarga (bulk) respetan los
+    límites de ancho de banda.
+    """
+    chunks = self.counted(chunks)
+    if bulk:
+      chunks = BulkStream(chunks)
+    self._write_stream(chunks)
+
+  def write_file(self, file_slice):
+    """
+    Envía un fragmento de archivo tal cual está en disco, respetando los
+    límites de ancho de banda.
+    """
+    metrics.add_bytes_out(self.command, file_slice.size)
+    self._write_file(file_slice)
+
+  def write_deferred(self, work):
+    """
+    Envía la respuesta que devuelve `work', una función que puede tardar
+    (por ejemplo, leyendo un archivo entero). Como puede correr en otro
+    hilo, no debe tocar el estado de la conexión.
+    """
+    command = self.command
+
+    def counted():
+      response = work()
+      metrics.add_bytes_out(command, len(response))
+      return response
+    self._write_deferred(Deferred(counted))
+
+  def counted(self, chunks):
+    """
+    Generador que devuelve los bloques del iterable, contándolos en las
+    métricas del comando que los generó a medida que se generan.
+    """
+    command = self.command
+    for chunk in chunks:
+      metrics.add_bytes_out(command, len(chunk))
+      yield chunk
+
+  def _write(self, data: bytes):
+    """
+    Encola los bytes sin copiarlos. Se envían juntos al terminar el
+    pedido, o antes si se acumulan WRITE_COALESCE_BYTES.
+    """
+    if len(data) > 0:
+      self.pending.append(memoryview(data))
+      self.pending_bytes += len(data)
+      if self.pending_bytes >= WRITE_COALESCE_BYTES:
+        self.send_pending()
+
+  def shape(self, size):
+    """
+    Reserva `size' bytes de ancho de banda y devuelve los segundos que
+    hay que esperar antes de enviarlos.
+    """
+    return shaper.reserve(self.bucket, size)
+
+  def throttle(self, size):
+    """
+    Espera hasta poder enviar `size' bytes de una descarga. Lo ya
+    encolado sale antes, para no demorar otras respuestas.
+    """
+    delay = self.shape(size)
+    if delay > 0:
+      self.send_pending()
+      time.sleep(delay)
+
+  def _write_stream(self, chunks):
+    """
+    Escribe en orden los bloques de bytes de un iterable, generando cada
+    uno recién cuando se envió el anterior. Si el archivo del que se leen
+    se achica, el FileShrunk (un OSError) termina la conexión.
+    """
+    bulk = isinstance(chunks, BulkStream)
+    for chunk in chunks:
+      if bulk:
+        self.throttle(len(chunk))
+      self._write(chunk)
+
+  def _write_deferred(self, deferred):
+    """
+    Calcula la respuesta en el propio hilo de la conexión y la encola.
+    """
+    self._write(deferred.work())
+
+  def _write_file(self, file_slice):
+    """
+    Envía un fragmento de archivo directamente del disco al socket.
+    Si el archivo se achicó y no se pudo enviar completo, se corta la
+    conexión: el cliente no tiene otra forma de saberlo.
+    """
+    # Lo encolado sale en el mismo segmento que el principio del archivo,
+    # salvo que haya que esperar ancho de banda antes de enviarlo
+    self.send_pending(more=not shaper.enabled())
+    # Con límites de ancho de banda se envían bloques más chicos, para
+    # intercalarlos con los de otras conexiones
+    block_size = SHAPE_BLOCK_SIZE if shaper.enabled() else SENDFILE_BLOCK_SIZE
+    try:
+      while file_slice.size > 0:
+        self.throttle(min(file_slice.size, block_size))
+        self.update_deadline(sending=True)
+        if file_slice.send(self.socket, block_size) == 0:
+          self.close()
+          break
+    finally:
+      self.deadline = None
+
+  def send_pending(self, more=False):
+    """
+    Envía los bytes encolados con sendmsg, de a IOV_MAX buffers por
+    llamada, bloqueando hasta enviarlos todos. Con more, se avisa al
+    kernel que sigue más respuesta, para que no la parta en segmentos
+    chicos.
+    """
+    buffers = self.pending
+    self.pending = []
+    self.pending_bytes = 0
+    flags = MSG_MORE if more else 0
+    first = 0
+    try:
+      while first < len(buffers):
+        self.update_deadline(sending=True)
+        bytes_sent = self.socket.sendmsg(
+            buffers[first:first + IOV_MAX], (), flags)
         assert bytes_sent > 0
-        message = message[bytes_sent:]
+        first = advance_buffers(buffers, first, bytes_sent)
+    finally:
+      self.deadline = None
 
   # Desconexión del socket
   def close(self):
     """
-    Desconecta el cliente del server
+    Desconecta el cliente del server, enviando antes lo encolado.
     """
     self.connected = False
-    self.socket.close()
+    try:
+      self.send_pending()
+    finally:
+      self.socket.close()
 
   # Handler de errores del server o pedidos del cliente
   def check_error(self):
@@ -117,7 +503,11 @@ class Connection(object):
     self.status, imprime el mensaje de error y termina en caso necesario
     """
 
-    if self.status != CODE_OK:
+    if self.status != CODE_OK and self.expired:
+      # La cerró el Reaper: no queda a quién responder
+      self.connected = False
+    elif self.status != CODE_OK:
+      metrics.add_error(self.command, self.status)
       self.send(self.mk_command())
       # Si es error que comienza en 1, se cierra conexión con quit.
       # Caso contrario, no se atiende el pedido pero se sigue la conexión
@@ -125,6 +515,13 @@ class Connection(object):
         self.status = CODE_OK
         self.quit("quit")
 
+  def refuse(self, status):
+    """
+    Rechaza la conexión con el error fatal indicado, sin atender pedidos
+    """
+    self.status = status
+    self.check_error()
+
   # Comandos de HFTP
   def mk_command(self):
     """
@@ -156,14 +553,14 @@ class Connection(object):
     Devuelve del listado de archivos del servidor
     en el directorio en el que está
     """
-    return os.listdir(self.dir)
+    return self.index.listing()
 
   def file_exists(self, filename):
     """
     Responde si el archivo especificado existe en
     el directorio del servidor
     """
-    return filename in self.list_files()
+    return self.index.contains(filename)
 
   def filename_is_valid(self, filename):
     """
@@ -187,11 +584,51 @@ class Connection(object):
     if not self.cnt_args_is_valid(command, 0):
       self.status = INVALID_ARGUMENTS
     else:
-      buffer = self.mk_command() + EOL
-      all_files = self.list_files()
-      for file in all_files:
-        buffer += file + EOL
-      self.send(buffer)
+      # Se arma de una vez: un join en lugar de una copia por archivo
+      lines = [self.mk_command()] + self.list_files() + [""]
+      self.send(EOL.join(lines))
+
+  def get_listing_metadata(self, command):
+    """
+    Devuelve una línea por archivo del directorio del servidor con su
+    nombre, su tamaño en bytes y su fecha de modificación en
+    nanosegundos, recorriendo el directorio una sola vez.
+    """
+    if not self.cnt_args_is_valid(command, 0):
+      self.status = INVALID_ARGUMENTS
+    else:
+      entries = self.index.scan()
+      self.send(self.mk_command())
+      self.write_stream(self.metadata_lines(entries))
+
+  def metadata_lines(self, entries):
+    """
+    Generador que devuelve las líneas de get_listing_metadata ya
+    codificadas, de a METADATA_BLOCK_FILES archivos, seguidas de la
+    línea vacía final.
+    """
+    for start in range(0, len(entries), METADATA_BLOCK_FILES):
+      lines = [f"{filename} {identity[2]} {identity[1]}{EOL}"
+               for filename, identity in
+               entries[start:start + METADATA_BLOCK_FILES]]
+      yield "".join(lines).encode('ascii')
+    yield EOL.encode('ascii')
+
+  def get_sizes(self, command):
+    """
+    Devuelve el tamaño en bytes de cada uno de los archivos pedidos, una
+    línea por archivo y en el mismo orden; -1 si el archivo no está en
+    el directorio del servidor.
+    """
+    filenames = self.command_args(command)
+    if len(filenames) == 0 or not all(map(self.filename_is_valid, filenames)):
+      self.status = INVALID_ARGUMENTS
+    else:
+      lines = [self.mk_command()]
+      for filename in filenames:
+        identity = self.index.stat(filename)
+        lines.append(str(identity[2]) if identity is not None else "-1")
+      self.send(EOL.join(lines))
 
   def get_metadata(self, command):
     """
@@ -205,17 +642,35 @@ class Connection(object):
 
       if not self.filename_is_valid(filename):
         self.status = INVALID_ARGUMENTS
-      elif not self.file_exists(filename):
-        self.status = FILE_NOT_FOUND
       else:
-        size = os.path.getsize(self.file_path(filename))
-        buffer = self.mk_command() + EOL + str(size)
-        self.send(buffer)
+        identity = self.index.stat(filename)
+        if identity is None:
+          self.status = FILE_NOT_FOUND
+        else:
+          size = identity[2]
+          buffer = self.mk_command() + EOL + str(size)
+          self.send(buffer)
 
-  def get_slice(self, command):
+  def open_cached(self, filename):
     """
-    Devuelve el fragmento de un archivo pedido en base64.
-    El archivo debe estar en el directorio del servidor.
+    Devuelve el archivo abierto del caché compartido, o None dejando
+    FILE_NOT_FOUND en self.status.
+    """
+    identity = self.index.stat(filename)
+    if identity is None:
+      self.status = FILE_NOT_FOUND
+      return None
+    try:
+      return file_cache.get(self.file_path(filename), identity)
+    except OSError:
+      self.status = FILE_NOT_FOUND
+      return None
+
+  def slice_args(self, command):
+    """
+    Valida los argumentos de un pedido de fragmento de archivo.
+    Devuelve (archivo abierto, offset, size), o None dejando el error
+    en self.status.
     """
     if not self.cnt_args_is_valid(command, 3):
       self.status = INVALID_ARGUMENTS
@@ -224,27 +679,177 @@ class Connection(object):
 
       if not self.filename_is_valid(filename) or not offset.isnumeric() or not size.isnumeric():
         self.status = INVALID_ARGUMENTS
-      elif not self.file_exists(filename):
-        self.status = FILE_NOT_FOUND
-      elif int(offset) + int(size) > os.path.getsize(self.file_path(filename)) or int(offset) < 0:
+      else:
+        cached = self.open_cached(filename)
+        if cached is None:
+          return None
+        if int(offset) + int(size) > cached.size or int(offset) < 0:
+          self.status = BAD_OFFSET
+        else:
+          return cached, int(offset), int(size)
+    return None
+
+  def get_slice(self, command):
+    """
+    Devuelve el fragmento de un archivo pedido en base64.
+    El archivo debe estar en el directorio del servidor.
+    """
+    args = self.slice_args(command)
+    if args is not None:
+      cached, offset, size = args
+
+      header = (self.mk_command() + EOL).encode('ascii')
+      trailer = EOL.encode('ascii')
+      if len(header) + b64_length(size) + len(trailer) > response_cache.max_item:
+        self.write(header)
+        self.write_stream(self.encoded_slice(cached, offset, size), bulk=True)
+        self.write(trailer)
+      else:
+        # Respuesta chica: se arma entera y se guarda para repetirla
+        key = (cached.identity, offset, size)
+        response = response_cache.get(key)
+        if response is None:
+          try:
+            data = cached.read(offset, size)
+          except FileShrunk:
+            self.status = BAD_OFFSET
+            return
+          response = b''.join((header, b64encode(data), trailer))
+          response_cache.put(key, response)
+        self.write_stream((response,), bulk=True)
+
+  def get_slice_raw(self, command):
+    """
+    Devuelve el fragmento de un archivo pedido tal cual está en disco:
+    la línea de estado seguida de exactamente `size' bytes, sin
+    terminador. Los bytes se envían con sendfile, sin pasar por Python.
+    """
+    args = self.slice_args(command)
+    if args is not None:
+      cached, offset, size = args
+
+      buffer = self.mk_command()
+      self.send(buffer)
+      if size > 0:
+        self.write_file(FileSlice(cached, offset, size))
+
+  def get_slice_zlib(self, command):
+    """
+    Devuelve el fragmento de un archivo pedido comprimido con zlib, con
+    el nivel opcional dado como cuarto argumento (0 a 9).
+
+    A la línea de estado le sigue una línea con la codificación usada:
+    - "zlib": bloques formados por una línea con su largo seguida de
+      los bytes comprimidos, terminados por una línea con largo 0.
+    - "raw": si los datos no se comprimen bien, exactamente `size' bytes
+      tal cual están en disco, como en get_slice_raw.
+    """
+    args = command.rsplit(' ')
+    level = str(COMPRESS_LEVEL)
+    if len(args) == 5:
+      level = args.pop()
+    if not level.isnumeric() or int(level) > 9:
+      self.status = INVALID_ARGUMENTS
+      return
+    args = self.slice_args(' '.join(args))
+    if args is not None:
+      cached, offset, size = args
+
+      # Se estima con una muestra, comprimida rápido, si vale la pena
+      try:
+        sample = cached.read(offset, min(size, COMPRESS_SAMPLE))
+      except FileShrunk:
         self.status = BAD_OFFSET
+        return
+      compressible = (len(zlib.compress(sample, 1)) <
+                      len(sample) * COMPRESS_MIN_RATIO)
+      if compressible:
+        self.send(self.mk_command() + EOL + "zlib")
+        self.write_stream(
+            self.compressed_slice(cached, offset, size, int(level)),
+            bulk=True)
       else:
-        offset, size = int(offset), int(size)
+        self.send(self.mk_command() + EOL + "raw")
+        if size > 0:
+          self.write_file(FileSlice(cached, offset, size))
+
+  def compressed_slice(self, cached: CachedFile, offset, size, level):
+    """
+    Generador que comprime el fragmento pedido del archivo abierto de a
+    SLICE_BLOCK_SIZE bytes y devuelve los bloques de la respuesta de
+    get_slice_zlib, cada uno precedido por su largo. Si el archivo se
+    achica mientras tanto, lanza FileShrunk.
+    """
+    compressor = zlib.compressobj(level)
+    for data in cached.blocks(offset, size):
+      block = compressor.compress(data)
+      if block:
+        yield f"{len(block)}{EOL}".encode('ascii')
+        yield block
+    block = compressor.flush()
+    if block:
+      yield f"{len(block)}{EOL}".encode('ascii')
+      yield block
+    yield f"0{EOL}".encode('ascii')
 
-        buffer = self.mk_command()
-        self.send(buffer)
+  def get_checksums(self, command):
+    """
+    Devuelve los hashes por bloque de un archivo, para que el cliente
+    pida solo los bloques que cambiaron. A la línea de estado le sigue
+    una línea con el tamaño del archivo y el tamaño de bloque, y una
+    línea por bloque con su hash, terminadas por una línea vacía.
+    """
+    if not self.cnt_args_is_valid(command, 1):
+      self.status = INVALID_ARGUMENTS
+      return
+    filename = self.command_args(command)[0]
+    if not self.filename_is_valid(filename):
+      self.status = INVALID_ARGUMENTS
+      return
+    cached = self.open_cached(filename)
+    if cached is None:
+      return
+    lines = [self.mk_command(), f"{cached.size} {checksum_cache.block_size}"]
+    digests = checksum_cache.lookup(self.dir, filename, cached)
+    if digests is not None:
+      self.send(EOL.join(lines + digests + [""]))
+      return
+
+    # Leer o calcular el índice puede llevar segundos: se hace aparte
+    directory = self.dir
+    command = self.command
 
-        with open(self.dir + os.path.sep + filename, 'rb') as file_data:
+    def reply():
+      try:
+        digests = checksum_cache.get(directory, filename, cached)
+      except OSError:
+        # Cambió mientras se leía: ya no es el archivo que se pidió
+        metrics.add_error(command, FILE_NOT_FOUND)
+        return (f"{FILE_NOT_FOUND} {error_messages[FILE_NOT_FOUND]}"
+                f"{EOL}").encode('ascii')
+      return EOL.join(lines + digests + ["", ""]).encode('ascii')
+    self.write_deferred(reply)
 
-          bytes_read = b''
-          while size > 0:
-            file_data.seek(offset)
-            bytes_read += file_data.read(size)
-            size -= len(bytes_read)
-            offset += len(bytes_read)
+  def encoded_slice(self, cached: CachedFile, offset, size):
+    """
+    Generador que recorre el fragmento pedido del archivo abierto en
+    bloques de SLICE_BLOCK_SIZE bytes y devuelve cada uno codificado en
+    base64. Como los bloques son múltiplos de 3, su concatenación es la
+    codificación del fragmento. Si el archivo se achica mientras tanto,
+    lanza FileShrunk.
+    """
+    for block in cached.blocks(offset, size):
+      yield b64encode(block)
 
-          self.send(bytes_read, encoding='b64')
-          self.send('')
+  def stats(self, command):
+    """
+    Devuelve las métricas del servidor, una por línea con la forma
+    "nombre valor", terminadas por una línea vacía.
+    """
+    if not self.cnt_args_is_valid(command, 0):
+      self.status = INVALID_ARGUMENTS
+    else:
+      self.send(EOL.join([self.mk_command()] + metrics.render_text() + [""]))
 
   def quit(self, command):
     """
@@ -262,11 +867,17 @@ class Connection(object):
     Elige la operación a la cual dirigir el pedido
     en base a la switch table
     """
-    do_oper = self.switch_table.get(data.split(' ')[0], None)
+    name = data.split(' ')[0]
+    do_oper = self.switch_table.get(name, None)
+    # Los comandos inexistentes se agrupan, para acotar las métricas
+    self.command = name if do_oper is not None else INVALID_COMMAND_NAME
+    start = time.perf_counter()
     if do_oper is None:
       self.status = INVALID_COMMAND
     else:
       do_oper(data)
+    metrics.observe(self.command, time.perf_counter() - start,
+                    len(data) + len(EOL))
 
   def handle(self):
     """
@@ -279,11 +890,447 @@ class Connection(object):
 
     while self.connected is True:
       data = self.read_line()
+      self.process(data)
+      self.process_pipelined()
+      self.send_pending()
+
+  def process(self, data):
+    """
+    Atiende un pedido ya leído, respondiendo el error correspondiente
+    si lo hubo durante la lectura o durante la operación.
+    """
+    self.command = NO_COMMAND
+    self.check_error()
+    # Si no debo procesar este pedido, no entro y vuelvo a OK
+    # Si debo cortar, se ve en la guarda del while
+    # Si está todo bien, entro a la operación
+    if self.connected is True and self.status is CODE_OK:
+      self.operation(data)
       self.check_error()
-      # Si no debo procesar este pedido, no entro y vuelvo a OK
-      # Si debo cortar, se ve en la guarda del while
-      # Si está todo bien, entro a la operación
-      if self.connected is True and self.status is CODE_OK:
-        self.operation(data)
-        self.check_error()
-      self.status = CODE_OK
+    self.status = CODE_OK
+
+  def process_pipelined(self):
+    """
+    Atiende en orden los pedidos que el cliente ya envió sin esperar
+    respuesta, hasta MAX_PIPELINED, para que sus respuestas salgan
+    juntas en lugar de una por vez.
+    """
+    count = 0
+    while (self.connected is True and count < MAX_PIPELINED and
+           self.buffer.has_line()):
+      self.process(self.take_line())
+      count += 1
+
+
+class AsyncConnection(Connection):
+  """
+  Conexión atendida con streams de asyncio. Reutiliza los comandos de
+  Connection, pero las lecturas no bloquean el event loop y las
+  respuestas se encolan y se envían de a un bloque, esperando a que el
+  cliente lea el anterior.
+  """
+
+  def __init__(self, reader: asyncio.StreamReader,
+               writer: asyncio.StreamWriter, directory):
+    super().__init__(writer.get_extra_info('socket'), directory)
+    self.reader = reader
+    self.writer = writer
+    # Respuestas pendientes de enviar, como iterables de bloques de bytes
+    self.output = deque()
+    # Tarea que atiende la conexión, para cancelarla si vence
+    self.task = None
+
+  async def _recv(self):
+    """
+    Recibe datos del stream y acumula en el buffer interno.
+    """
+    try:
+      data = await self.reader.read(RECV_SIZE)
+    except ConnectionError:
+      data = b''
+    self.feed(data)
+
+  async def read_line(self):
+    """
+    Igual que Connection.read_line, pero cediendo el control al
+    event loop mientras se espera la línea.
+    """
+    while not self.buffer.has_line() and self.status == CODE_OK:
+      self.update_deadline()
+      await self._recv()
+    self.deadline = None
+
+    return self.take_line()
+
+  def expire(self):
+    """
+    Cierra la conexión por vencida, cancelando la tarea que la atiende
+    en la lectura o el envío en curso.
+    """
+    self.expired = True
+    self.task.cancel()
+
+  def _write(self, data: bytes):
+    """
+    Encola los bytes; se envían al hacer flush().
+    """
+    self.output.append((data,))
+
+  def _write_stream(self, chunks):
+    """
+    Encola un iterable de bloques; se generan de a uno al hacer flush().
+    """
+    self.output.append(chunks)
+
+  def _write_file(self, file_slice):
+    """
+    Encola un fragmento de archivo; se envía con sendfile al hacer flush().
+    """
+    self.output.append(file_slice)
+
+  def _write_deferred(self, deferred):
+    """
+    Encola una respuesta; se calcula en background al hacer flush().
+    """
+    self.output.append(deferred)
+
+  async def flush(self):
+    """
+    Envía las respuestas pendientes, esperando que el transporte se
+    vacíe entre bloque y bloque.
+    """
+    while self.output:
+      item = self.output.popleft()
+      if isinstance(item, FileSlice):
+        block_size = (SHAPE_BLOCK_SIZE if shaper.enabled()
+                      else SENDFILE_BLOCK_SIZE)
+        while item.size > 0:
+          size = min(item.size, block_size)
+          await self.throttle(size)
+          self.update_deadline(sending=True)
+          bytes_sent = await asyncio.get_running_loop().sendfile(
+              self.writer.transport, item.file, item.offset, size)
+          item.offset += bytes_sent
+          item.size -= bytes_sent
+          if bytes_sent < size:
+            self.output.clear()
+            self.connected = False
+            break
+        continue
+      if isinstance(item, Deferred):
+        # La espera no es culpa del cliente
+        self.deadline = None
+        response = await asyncio.get_running_loop().run_in_executor(
+            background, item.work)
+        self.update_deadline(sending=True)
+        self.writer.write(response)
+        await self.writer.drain()
+        continue
+      bulk = isinstance(item, BulkStream)
+      try:
+        for chunk in item:
+          if bulk:
+            await self.throttle(len(chunk))
+          self.update_deadline(sending=True)
+          self.writer.write(chunk)
+          await self.writer.drain()
+      except FileShrunk:
+        # Como con un FileSlice: la respuesta ya empezó y no se puede
+        # completar
+        self.output.clear()
+        self.connected = False
+
+  async def throttle(self, size):
+    """
+    Igual que Connection.throttle, pero cediendo el control al event
+    loop mientras se espera.
+    """
+    delay = self.shape(size)
+    if delay > 0:
+      # La espera no es culpa del cliente
+      self.deadline = None
+      await asyncio.sleep(delay)
+
+  def close(self):
+    """
+    Marca la conexión como terminada. El stream se cierra una vez
+    enviadas las respuestas pendientes.
+    """
+    self.connected = False
+
+  async def handle(self):
+    """
+    Atiende eventos de la conexión hasta que termina.
+    """
+    # El directorio del servidor no existe
+    if not os.path.exists(self.dir):
+      self.status = INTERNAL_ERROR
+      self.check_error()
+
+    self.task = asyncio.current_task()
+    try:
+      await self.flush()
+      while self.connected is True:
+        data = await self.read_line()
+        self.process(data)
+        self.process_pipelined()
+        await self.flush()
+    except ConnectionError:
+      self.connected = False
+    except asyncio.CancelledError:
+      if not self.expired:
+        raise
+      # Lo pendiente de enviar se descarta: el cliente no lo va a leer
+      self.connected = False
+      self.writer.transport.abort()
+
+
+class ReactorConnection(Connection):
+  """
+  Conexión atendida por un reactor de selectors en un único hilo.
+  El socket es no bloqueante: las lecturas parciales se acumulan en el
+  buffer y las respuestas quedan en una cola de salida (de bytes o de
+  iterables de bloques) que se envía a medida que el cliente las lee.
+  """
+
+  def __init__(self, nsocket: socket, directory, notify=None):
+    super().__init__(nsocket, directory)
+    self.socket.setblocking(False)
+    self.output = deque()
+    # Momento hasta el que se pausa el envío por falta de ancho de banda,
+    # y bytes ya reservados del fragmento de archivo en curso
+    self.resume_at = None
+    self.credit = 0
+    # Si se espera una respuesta calculada en background, y a quién se
+    # avisa, desde ese hilo, cuando termina
+    self.waiting = False
+    self.notify = notify
+
+  def _recv(self):
+    """
+    Recibe los datos disponibles sin bloquear y acumula en el buffer.
+    """
+    try:
+      received = self.buffer.recv_into(self.socket)
+    except BlockingIOError:
+      return
+    except OSError:
+      # Cualquier error del socket termina solo esta conexión
+      received = 0
+    if received == 0:
+      self.disconnected()
+
+  def _write(self, data: bytes):
+    """
+    Encola los bytes para enviarlos cuando el socket esté listo.
+    """
+    if len(data) > 0:
+      self.output.append(memoryview(data))
+
+  def _write_stream(self, chunks):
+    """
+    Encola un iterable de bloques, que se generan de a uno a medida que
+    el socket acepta datos.
+    """
+    self.output.append(iter(chunks))
+
+  def _write_file(self, file_slice):
+    """
+    Encola un fragmento de archivo, que se envía con sendfile a medida
+    que el socket acepta datos.
+    """
+    self.output.append(file_slice)
+
+  def _write_deferred(self, deferred):
+    """
+    Encola una respuesta, que se calcula en background al llegar a la
+    cabeza de la cola.
+    """
+    self.output.append(deferred)
+
+  def flush(self):
+    """
+    Envía todo lo posible de la cola de salida sin bloquear. Si una
+    descarga se queda sin ancho de banda, se pausa hasta resume_at.
+    """
+    if self.resume_at is not None:
+      if time.monotonic() < self.resume_at:
+        return
+      self.resume_at = None
+    while self.output:
+      if isinstance(self.output[0], Deferred):
+        deferred = self.output[0]
+        if deferred.future is None:
+          deferred.future = background.submit(deferred.work)
+          if self.notify is not None:
+            deferred.future.add_done_callback(
+                lambda future: self.notify(self))
+        # Mientras no termine, el reactor deja de vigilar el socket
+        self.waiting = not deferred.future.done()
+        if self.waiting:
+          return
+        self.output[0] = memoryview(deferred.future.result())
+        continue
+      if isinstance(self.output[0], FileSlice):
+        file_slice = self.output[0]
+        limit = None
+        if shaper.enabled():
+          if self.credit <= 0:
+            self.credit = min(file_slice.size, SHAPE_BLOCK_SIZE)
+            if self.pause(self.credit):
+              return
+          limit = self.credit
+        try:
+          bytes_sent = file_slice.send(self.socket, limit)
+        except BlockingIOError:
+          return
+        except OSError:
+          bytes_sent = 0
+        if limit is not None:
+          self.credit -= bytes_sent
+        if bytes_sent == 0:
+          # El archivo se achicó o el cliente se fue: no hay forma de
+          # seguir respetando el protocolo
+          self.output.clear()
+          self.connected = False
+        elif file_slice.size == 0:
+          self.output.popleft()
+        continue
+      if not isinstance(self.output[0], memoryview):
+        # Genera el próximo bloque del iterable a la cabeza de la cola
+        try:
+          chunk = next(self.output[0], None)
+        except FileShrunk:
+          # Como con un FileSlice: la respuesta no se puede completar
+          self.output.clear()
+          self.connected = False
+          return
+        if chunk is None:
+          self.output.popleft()
+        elif len(chunk) > 0:
+          self.output.appendleft(memoryview(chunk))
+          if isinstance(self.output[1], BulkStream) and self.pause(len(chunk)):
+            return
+        continue
+      # Los bytes consecutivos de la cola salen en un único sendmsg
+      buffers = []
+      size = 0
+      for item in self.output:
+        if not isinstance(item, memoryview) or len(buffers) == IOV_MAX:
+          break
+        buffers.append(item)
+        size += len(item)
+      following = None
+      if len(buffers) < len(self.output):
+        following = self.output[len(buffers)]
+      if (following is not None and len(buffers) < IOV_MAX and
+          size < WRITE_COALESCE_BYTES and
+          not isinstance(following, (memoryview, FileSlice, Deferred))):
+        # Genera ya el próximo bloque del iterable que sigue, para que
+        # salga en el mismo sendmsg y no como un segmento chico aparte
+        try:
+          chunk = next(following, None)
+        except FileShrunk:
+          self.output.clear()
+          self.connected = False
+          return
+        if chunk is None:
+          del self.output[len(buffers)]
+        elif len(chunk) > 0:
+          self.output.insert(len(buffers), memoryview(chunk))
+          if isinstance(following, BulkStream) and self.pause(len(chunk)):
+            return
+        continue
+      # Solo se avisa que sigue más si lo siguiente ya tiene bytes: un
+      # iterable puede no generar nada más, y lo enviado quedaría
+      # retenido por el kernel hasta su timer (~200 ms)
+      flags = 0
+      if isinstance(following, (memoryview, FileSlice)):
+        flags = MSG_MORE
+      try:
+        bytes_sent = self.socket.sendmsg(buffers, (), flags)
+      except BlockingIOError:
+        return
+      except OSError:
+        self.output.clear()
+        self.connected = False
+        return
+      sent = advance_buffers(buffers, 0, bytes_sent)
+      for _ in range(sent):
+        self.output.popleft()
+      if sent < len(buffers):
+        self.output[0] = buffers[sent]
+        return
+
+  def pause(self, size):
+    """
+    Reserva `size' bytes de ancho de banda. Si hay que esperar, anota
+    hasta cuándo en resume_at y devuelve True.
+    """
+    delay = self.shape(size)
+    if delay > 0:
+      self.resume_at = time.monotonic() + delay
+      return True
+    return False
+
+  def close(self):
+    """
+    Marca la conexión como terminada. El socket lo cierra el reactor
+    una vez enviada la cola de salida.
+    """
+    self.connected = False
+
+  def expire(self):
+    """
+    Descarta la cola de salida y marca la conexión como terminada, para
+    que el reactor la cierre.
+    """
+    self.expired = True
+    self.output.clear()
+    self.connected = False
+
+  def advance(self):
+    """
+    Atiende los pedidos completos del buffer cuando ya se envió la
+    respuesta de los anteriores. Los que llegaron juntos se atienden
+    juntos y sus respuestas se envían en la misma tanda.
+    """
+    self.flush()
+    while (self.connected is True and not self.output and
+           (self.buffer.has_line() or self.status != CODE_OK)):
+      self.process(self.take_line())
+      self.process_pipelined()
+      self.flush()
+    if self.resume_at is not None or self.waiting:
+      # Mientras está pausada no se espera nada del cliente
+      self.deadline = None
+    else:
+      self.update_deadline(sending=bool(self.output))
+
+  def start(self):
+    """
+    Comienza a atender la conexión recién aceptada.
+    """
+    # El directorio del servidor no existe
+    if not os.path.exists(self.dir):
+      self.status = INTERNAL_ERROR
+      self.check_error()
+    self.advance()
+
+  def handle_event(self, mask):
+    """
+    Avanza la conexión ante un evento del selector.
+    """
+    if mask & selectors.EVENT_READ:
+      self._recv()
+    self.advance()
+
+  def events(self):
+    """
+    Eventos del selector que espera la conexión; 0 si ya terminó.
+    """
+    if self.output:
+      return selectors.EVENT_WRITE
+    if self.connected is True:
+      return selectors.EVENT_READ
+    return 0
@@ -9,8 +9,105 @@ DEFAULT_DIR = 'testdata'
 DEFAULT_ADDR = '0.0.0.0'  # 0.0.0.0 representa todas las IPv4 del server
 DEFAULT_PORT = 19500
 
-MAX_CLIENT = 5
-CMD_TIMEOUT = 5000
+# Segundos que una conexión puede esperar sin pedidos, y que tiene el
+# cliente para completar un pedido empezado o para aceptar cada parte de
+# una respuesta; cada cuántos segundos se cierran las conexiones vencidas
+IDLE_TIMEOUT = 60
+COMMAND_TIMEOUT = 20
+REAPER_INTERVAL = 1
+# Bytes que se envían por vez con sendfile: el plazo del envío se renueva
+# con cada uno, así que un cliente lento debe poder recibirlos dentro de
+# COMMAND_TIMEOUT (a 2 ** 18, basta con leer unos 13 KB/s)
+SENDFILE_BLOCK_SIZE = 2 ** 18
+# Límites de ancho de banda de las descargas: bytes que se envían por vez
+# mientras están activos, para intercalar las conexiones, y segundos de
+# envío que puede acumular cada balde
+SHAPE_BLOCK_SIZE = 2 ** 18
+SHAPE_BURST_SECONDS = 0.1
+# Bytes del archivo que get_slice lee y codifica por vez (múltiplo de 3)
+SLICE_BLOCK_SIZE = 3 * 2 ** 16
+# Archivos abiertos que conserva el caché de archivos (un descriptor cada uno)
+FILE_CACHE_FILES = 128
+# Segundos durante los que no se confía en la fecha de modificación del
+# directorio servido luego de un cambio (si no hay inotify)
+DIR_MTIME_SLACK = 1
+# Bytes de respuestas de get_slice ya codificadas que se guardan, y
+# tamaño máximo de cada una
+RESPONSE_CACHE_BYTES = 64 * 2 ** 20
+RESPONSE_CACHE_MAX_ITEM = 2 ** 20
+# Archivos cuyo stat se recuerda, y por cuántos segundos si no hay inotify
+STAT_CACHE_SIZE = 4096
+STAT_CACHE_TTL = 1
+# Bytes que se piden por vez al socket, y tamaño inicial del buffer de
+# recepción (crece si llega una línea más larga, y vuelve a este tamaño
+# al vaciarse)
+RECV_SIZE = 2 ** 16
+RECV_BUFFER_SIZE = 2 ** 12
+# Bytes que el cliente pide por vez al recibir un fragmento crudo
+RAW_RECV_SIZE = 2 ** 20
+# Bytes de respuesta que se juntan antes de enviarlos con un único sendmsg
+WRITE_COALESCE_BYTES = 2 ** 18
+# Pedidos ya recibidos que el server atiende antes de enviar sus
+# respuestas juntas, y pedidos que el cliente envía sin esperar respuesta
+MAX_PIPELINED = 64
+PIPELINE_WINDOW = 128
+# Bytes de cada trozo de una descarga en paralelo, y cuántas veces se
+# reintenta un trozo que falló
+RANGE_SIZE = 2 ** 22
+RANGE_RETRIES = 3
+# Sufijo del archivo donde se baja en paralelo, hasta completarlo
+PARTIAL_SUFFIX = '.part'
+# Conexiones libres por servidor que guarda el pool de clientes
+POOL_MAX_IDLE = 8
+# Archivos por bloque de la respuesta de get_listing_metadata
+METADATA_BLOCK_FILES = 1024
+# Nivel de compresión por omisión de get_slice_zlib. Un fragmento se
+# envía sin comprimir si una muestra de sus primeros COMPRESS_SAMPLE
+# bytes no se achica al menos a COMPRESS_MIN_RATIO de su tamaño
+COMPRESS_LEVEL = 6
+COMPRESS_SAMPLE = 2 ** 16
+COMPRESS_MIN_RATIO = 0.9
+# Índice de hashes por bloque de get_checksums: tamaño de bloque, bytes
+# de cada hash, archivos cuyo índice se recuerda en memoria y sufijo del
+# directorio hermano del servido donde se guardan
+CHECKSUM_BLOCK_SIZE = 2 ** 20
+CHECKSUM_DIGEST_SIZE = 16
+CHECKSUM_CACHE_FILES = 256
+CHECKSUM_DIR_SUFFIX = '.sums'
+# Hilos que calculan las respuestas lentas (los índices de hashes) en los
+# modos de un único hilo, para no frenar al resto de las conexiones
+BACKGROUND_WORKERS = 4
+# Límites en segundos de los intervalos de los histogramas de latencia
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Conexiones pendientes de aceptar por el kernel (listen)
+LISTEN_BACKLOG = 1024
+# Pool de hilos del modo threads: crece de MIN_WORKERS a MAX_WORKERS
+MIN_WORKERS = 5
+MAX_WORKERS = 64
+# Segundos que un hilo de sobra espera ocioso antes de terminar
+WORKER_IDLE_TIMEOUT = 60
+# Conexiones que pueden esperar un hilo, y por cuántos segundos
+MAX_QUEUED = 256
+QUEUE_TIMEOUT = 10
+# Cada cuántos segundos se revisa la cola de conexiones en espera
+ADMISSION_CHECK_INTERVAL = 0.5
+# Segundos que se deja de aceptar conexiones si accept falla por falta
+# de recursos (por ejemplo, de descriptores de archivo)
+ACCEPT_RETRY_DELAY = 1
+
+# Modos de atención de clientes del servidor
+SERVE_MODES = ["threads", "asyncio", "selectors"]
+DEFAULT_MODE = "threads"
+# Segundos mínimos entre reinicios de un worker que falla al arrancar
+WORKER_RESTART_DELAY = 1
+# Fallos seguidos al arrancar tras los cuales el supervisor se rinde
+WORKER_MAX_FAILURES = 5
+# Perfilado bajo demanda (SIGUSR1): segundos entre muestras de las pilas
+# de los hilos, y duración máxima de una captura
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_SECONDS = 300
 
 NEWLINE = '\n'
 EOL = '\r\n'
@@ -18,6 +115,7 @@ EOL = '\r\n'
 CODE_OK = 0
 BAD_EOL = 100
 BAD_REQUEST = 101
+SERVER_BUSY = 102
 INTERNAL_ERROR = 199
 INVALID_COMMAND = 200
 INVALID_ARGUMENTS = 201
@@ -30,6 +128,7 @@ error_messages = {
     # 1xx: Errores fatales (no se pueden atender más pedidos)
     BAD_EOL: "BAD EOL",
     BAD_REQUEST: "BAD REQUEST",
+    SERVER_BUSY: "SERVER BUSY",
     INTERNAL_ERROR: "INTERNAL SERVER ERROR",
     # 2xx: Errores no fatales (no se pudo atender este pedido)
     INVALID_COMMAND: "NO SUCH COMMAND",
@@ -56,4 +155,10 @@ for i in range(ord('a'), ord('z') + 1):
 for i in range(ord('0'), ord('9') + 1):
   VALID_CHARS.add(chr(i))
 
-COMMANDS = ["get_file_listing", "get_metadata", "get_slice", "quit"]
+COMMANDS = ["get_file_listing", "get_metadata", "get_slice", "quit",
+            "get_slice_raw", "get_listing_metadata", "get_sizes",
+            "get_slice_zlib", "get_checksums", "stats"]
+# Nombres con los que se registran en las métricas los errores previos
+# a reconocer un comando y los comandos inexistentes
+NO_COMMAND = "none"
+INVALID_COMMAND_NAME = "invalid"
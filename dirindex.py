@@ -0,0 +1,315 @@
+# encoding: utf-8
+# Índice en memoria de los archivos del directorio servido, compartido
+# por todas las conexiones del servidor.
+
+import os
+import time
+import struct
+import ctypes
+import ctypes.util
+import threading
+from collections import OrderedDict
+from constants import *
+from filecache import file_identity
+
+# inotify(7) a través de la libc, si el sistema lo provee
+try:
+  _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  _inotify_init1 = _libc.inotify_init1
+  _inotify_add_watch = _libc.inotify_add_watch
+  _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+  _inotify_rm_watch = _libc.inotify_rm_watch
+except (OSError, AttributeError):
+  _libc = None
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Eventos que cambian el listado del directorio o los datos de un archivo
+IN_WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE |
+                 IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# Eventos del directorio padre que pueden reemplazar al directorio
+IN_PARENT_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_ONLYDIR)
+# struct inotify_event: wd, mask, cookie, len, seguido del nombre
+_EVENT = struct.Struct('iIII')
+
+
+def inotify_available():
+  return _libc is not None
+
+
+class DirIndex(object):
+  """
+  Conjunto de los nombres de archivo de un directorio, para responder
+  existencia en O(1) y listados sin recorrer el directorio en cada
+  pedido.
+
+  También guarda, para los archivos más consultados, su inodo, fecha de
+  modificación y tamaño, para no hacer un stat en cada pedido.
+
+  Con inotify se aplican los cambios de a uno a medida que ocurren y un
+  archivo modificado se quita del caché de stat. Si no está disponible,
+  se vuelve a listar el directorio cuando cambia su fecha de
+  modificación y los stat vencen a los stat_ttl segundos.
+  """
+
+  def __init__(self, directory, use_inotify=True, stat_ttl=STAT_CACHE_TTL,
+               max_stats=STAT_CACHE_SIZE):
+    self.dir = directory
+    self.names = set()
+    self.lock = threading.Lock()
+    # Caché LRU de stat: nombre -> (identidad del archivo, momento del stat)
+    self.stats = OrderedDict()
+    self.stat_ttl = stat_ttl
+    self.max_stats = max_stats
+    # Contador de cambios, para no guardar un stat hecho fuera del lock
+    # si el archivo cambió mientras tanto: cada cambio lo incrementa y
+    # anota su valor en changed[nombre], y reset es su valor en el
+    # último listado completo
+    self.generation = 0
+    self.changed = {}
+    self.reset = 0
+    # Estado del modo inotify: descriptor y watches sobre el directorio
+    # y sobre su padre, ya que el directorio puede borrarse y crearse
+    # de nuevo con el mismo nombre
+    self.inotify_fd = None
+    self.watch = None
+    self.parent_watch = None
+    self.parent, self.name = os.path.split(os.path.abspath(directory))
+    if use_inotify and inotify_available():
+      fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+      if fd >= 0:
+        self.inotify_fd = fd
+    # Estado del modo por fecha de modificación
+    self.identity = None
+    self.racy = False
+
+  def contains(self, filename):
+    """
+    Responde si el archivo está en el directorio.
+    """
+    with self.lock:
+      self._refresh()
+      return filename in self.names
+
+  def listing(self):
+    """
+    Devuelve la lista de archivos del directorio.
+    """
+    with self.lock:
+      self._refresh()
+      return list(self.names)
+
+  def stat(self, filename):
+    """
+    Devuelve la identidad (inodo, fecha de modificación, tamaño) del
+    archivo, o None si no está en el directorio.
+    """
+    with self.lock:
+      self._refresh()
+      if filename not in self.names:
+        return None
+      entry = self.stats.get(filename)
+      if entry is not None and (self.watch is not None or
+                                time.monotonic() - entry[1] < self.stat_ttl):
+        self.stats.move_to_end(filename)
+        return entry[0]
+      started = self.generation
+
+    # El stat se hace fuera del lock para no frenar al resto
+    try:
+      identity = file_identity(
+          os.stat(self.dir + os.path.sep + filename))
+    except OSError:
+      return None
+    with self.lock:
+      if self._unchanged(filename, started):
+        self.stats[filename] = (identity, time.monotonic())
+        self.stats.move_to_end(filename)
+        while len(self.stats) > self.max_stats:
+          self.stats.popitem(last=False)
+    return identity
+
+  def scan(self):
+    """
+    Recorre el directorio una sola vez con os.scandir y devuelve la
+    identidad (inodo, fecha de modificación, tamaño) de cada archivo,
+    como pares (nombre, identidad). De paso actualiza el caché de stat.
+    """
+    with self.lock:
+      self._refresh()
+      started = self.generation
+    entries = []
+    try:
+      with os.scandir(self.dir) as it:
+        for entry in it:
+          try:
+            entries.append((entry.name, file_identity(entry.stat())))
+          except OSError:
+            # Se borró durante el recorrido
+            pass
+    except OSError:
+      return []
+    now = time.monotonic()
+    with self.lock:
+      for filename, identity in entries[-self.max_stats:]:
+        if self._unchanged(filename, started):
+          self.stats[filename] = (identity, now)
+          self.stats.move_to_end(filename)
+      while len(self.stats) > self.max_stats:
+        self.stats.popitem(last=False)
+    return entries
+
+  def _unchanged(self, filename, since):
+    """
+    Responde si el archivo sigue en el índice sin cambios desde que el
+    contador de cambios valía `since'. Se llama con el lock tomado.
+    """
+    return (filename in self.names and self.reset <= since and
+            self.changed.get(filename, 0) <= since)
+
+  def _changed(self, filename):
+    """
+    Registra un cambio del archivo, descartando su stat.
+    """
+    self.generation += 1
+    self.changed[filename] = self.generation
+    self.stats.pop(filename, None)
+
+  def _rescan(self):
+    try:
+      self.names = set(os.listdir(self.dir))
+    except OSError:
+      self.names = set()
+    for filename in list(self.stats):
+      if filename not in self.names:
+        del self.stats[filename]
+
+  def _refresh(self):
+    """
+    Actualiza el índice. Se llama con el lock tomado.
+    """
+    if self.inotify_fd is not None:
+      self._refresh_inotify()
+    else:
+      self._refresh_mtime()
+
+  def _refresh_mtime(self):
+    try:
+      st = os.stat(self.dir)
+    except OSError:
+      self.names = set()
+      self.identity = None
+      return
+    identity = (st.st_ino, st.st_mtime_ns)
+    if identity != self.identity or self.racy:
+      scanned_at = time.time_ns()
+      self._rescan()
+      self.identity = identity
+      # Un cambio en el mismo tick del reloj del sistema de archivos que
+      # el listado no cambiaría la fecha: se desconfía hasta que pase
+      self.racy = st.st_mtime_ns >= scanned_at - DIR_MTIME_SLACK * 10 ** 9
+
+  def _refresh_inotify(self):
+    if self.parent_watch is None:
+      wd = _inotify_add_watch(
+          self.inotify_fd, os.fsencode(self.parent), IN_PARENT_MASK)
+      if wd >= 0:
+        self.parent_watch = wd
+
+    for wd, mask, name in self._read_events():
+      if wd == self.parent_watch:
+        # Se borró, movió o creó un directorio con el nombre del servido.
+        # El borrado no siempre llega como IN_DELETE_SELF: el inodo sigue
+        # vivo mientras haya archivos suyos abiertos.
+        if name == self.name:
+          self._unwatch()
+      elif wd == self.watch:
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+          self._unwatch()
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+          self.names.add(name)
+          self._changed(name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+          # Fuera del índice ya no se guarda su stat
+          self.names.discard(name)
+          self.changed.pop(name, None)
+          self.stats.pop(name, None)
+        elif mask & (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE):
+          self._changed(name)
+      elif mask & IN_Q_OVERFLOW:
+        # Se perdieron eventos: hay que volver a listar
+        self._unwatch()
+      # Otros eventos son de watches anteriores, ya reemplazados
+
+    if self.watch is None:
+      wd = _inotify_add_watch(
+          self.inotify_fd, os.fsencode(self.dir), IN_WATCH_MASK)
+      if wd < 0:
+        # El directorio no existe (todavía)
+        self.names = set()
+        return
+      # El watch va antes del listado para no perder cambios intermedios
+      self.watch = wd
+      self.stats.clear()
+      self.changed.clear()
+      self.generation += 1
+      self.reset = self.generation
+      self._rescan()
+
+  def _unwatch(self):
+    """
+    Deja de vigilar el directorio; se vuelve a listar en el próximo uso.
+    """
+    if self.watch is not None:
+      _inotify_rm_watch(self.inotify_fd, self.watch)
+      self.watch = None
+
+  def _read_events(self):
+    """
+    Devuelve los eventos pendientes como tuplas (wd, mask, nombre).
+    """
+    events = []
+    while True:
+      try:
+        data = os.read(self.inotify_fd, 65536)
+      except BlockingIOError:
+        return events
+      pos = 0
+      while pos < len(data):
+        wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+        pos += _EVENT.size
+        name = data[pos:pos + length].rstrip(b'\0')
+        pos += length
+        events.append((wd, mask, os.fsdecode(name)))
+
+
+# Índices compartidos, uno por directorio servido
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(directory, **options):
+  """
+  Devuelve el índice compartido del directorio, creándolo con las
+  opciones dadas si hace falta.
+  """
+  with _indexes_lock:
+    index = _indexes.get(directory)
+    if index is None:
+      index = _indexes[directory] = DirIndex(directory, **options)
+    return index
@@ -0,0 +1,181 @@
+# encoding: utf-8
+# Caché de archivos abiertos, compartido por todas
+# las conexiones del servidor.
+
+import os
+import threading
+from collections import OrderedDict
+from constants import *
+
+
+class FileShrunk(OSError):
+  """
+  El archivo se achicó mientras se leía.
+  """
+
+
+class CachedFile(object):
+  """
+  Archivo abierto en modo lectura. Se identifica por su inodo, fecha de
+  modificación y tamaño al momento de abrirlo.
+
+  Se lee con pread y no con un mapeo en memoria: si el archivo se trunca
+  durante una lectura, un mapeo mataría al proceso con SIGBUS, y pread
+  solo lee menos bytes.
+
+  El descriptor se libera cuando nadie más referencia al objeto, por lo
+  que un archivo quitado del caché sigue siendo válido para las
+  transferencias que lo estén usando.
+  """
+
+  def __init__(self, path):
+    self.file = None
+    self.file = open(path, 'rb')
+    self.identity = file_identity(os.fstat(self.file.fileno()))
+    self.size = self.identity[2]
+
+  def blocks(self, offset, size, block_size=SLICE_BLOCK_SIZE):
+    """
+    Generador que lee el fragmento de a `block_size' bytes en un único
+    buffer y devuelve una ventana de cada bloque, válida hasta pedir el
+    siguiente. Lanza FileShrunk si el archivo ya no tiene esos bytes.
+    """
+    end = offset + size
+    with memoryview(bytearray(min(size, block_size))) as buffer:
+      while offset < end:
+        with buffer[:min(block_size, end - offset)] as block:
+          self._read_into(block, offset)
+          yield block
+          offset += len(block)
+
+  def read(self, offset, size):
+    """
+    Lee y devuelve `size' bytes desde offset. Lanza FileShrunk si el
+    archivo ya no los tiene.
+    """
+    data = bytearray(size)
+    self._read_into(data, offset)
+    return data
+
+  def _read_into(self, buffer, offset):
+    """
+    Llena el buffer con los bytes del archivo desde offset.
+    """
+    done = 0
+    with memoryview(buffer) as view:
+      while done < len(view):
+        with view[done:] as free:
+          read = os.preadv(self.file.fileno(), [free], offset + done)
+        if read == 0:
+          raise FileShrunk("El archivo se achicó durante la lectura")
+        done += read
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+
+  def __del__(self):
+    self.close()
+
+
+def file_identity(st: os.stat_result):
+  """
+  Datos de un stat que cambian cuando el archivo se reemplaza o se
+  modifica.
+  """
+  return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class FileCache(object):
+  """
+  Caché LRU de archivos abiertos, indexado por path. Se descartan los
+  menos usados al superar max_files archivos abiertos, uno por
+  descriptor, y cada entrada se reemplaza si el archivo cambió de inodo
+  o de fecha de modificación.
+  """
+
+  def __init__(self, max_files=FILE_CACHE_FILES):
+    self.max_files = max_files
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, path, identity=None):
+    """
+    Devuelve el archivo abierto del path, abriéndolo si no está en el
+    caché o cambió desde que se abrió. Si ya se conoce la identidad
+    actual del archivo, se evita el stat. Puede fallar con OSError.
+    """
+    if identity is None:
+      identity = file_identity(os.stat(path))
+    with self.lock:
+      entry = self.entries.get(path)
+      if entry is not None and entry.identity == identity:
+        self.entries.move_to_end(path)
+        return entry
+
+    # Se abre fuera del lock para no frenar al resto de las conexiones
+    entry = CachedFile(path)
+    with self.lock:
+      self.entries.pop(path, None)
+      self.entries[path] = entry
+      # Siempre se conserva al menos el archivo recién abierto
+      while len(self.entries) > max(self.max_files, 1):
+        self.entries.popitem(last=False)
+    return entry
+
+
+class ResponseCache(object):
+  """
+  Caché LRU de respuestas ya codificadas, con un presupuesto total de
+  max_bytes. Las claves deben incluir la identidad del archivo, así una
+  respuesta queda obsoleta sola cuando el archivo cambia.
+  Lleva la cuenta de aciertos y fallos.
+  """
+
+  def __init__(self, max_bytes=RESPONSE_CACHE_BYTES,
+               max_item=RESPONSE_CACHE_MAX_ITEM):
+    self.max_bytes = max_bytes
+    # Respuestas más grandes no se guardan, para no vaciar el caché
+    self.max_item = max_item
+    self.entries = OrderedDict()
+    self.cached_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """
+    Devuelve la respuesta guardada con la clave, o None.
+    """
+    with self.lock:
+      response = self.entries.get(key)
+      if response is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self.entries.move_to_end(key)
+      return response
+
+  def put(self, key, response: bytes):
+    """
+    Guarda una respuesta, descartando las menos usadas si hace falta.
+    """
+    if len(response) > self.max_item:
+      return
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.cached_bytes -= len(old)
+      self.entries[key] = response
+      self.cached_bytes += len(response)
+      while self.cached_bytes > self.max_bytes:
+        key, old = self.entries.popitem(last=False)
+        self.cached_bytes -= len(old)
+
+  def stats(self):
+    """
+    Devuelve los contadores del caché.
+    """
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses,
+              'entries': len(self.entries), 'bytes': self.cached_bytes}
@@ -0,0 +1,128 @@
+# encoding: utf-8
+# Buffer de recepción por líneas, usado por el cliente y el servidor.
+
+import socket
+from constants import *
+
+EOL_BYTES = EOL.encode("ascii")
+
+
+class LineBuffer(object):
+  """
+  Buffer de recepción sobre un bytearray preasignado que se llena con
+  recv_into, sin crear objetos nuevos por cada bloque recibido.
+
+  Los datos pendientes de consumir están en data[start:end]. La búsqueda
+  del terminador se retoma donde terminó la anterior, así una línea
+  larga que llega en muchos bloques se recorre una sola vez.
+
+  Empieza chico, crece solo si una línea no entra, y vuelve al tamaño
+  inicial en cuanto se vacía, para que las conexiones ociosas ocupen poco.
+  """
+
+  def __init__(self, size=RECV_BUFFER_SIZE):
+    self.size = size
+    self.data = bytearray(size)
+    self.start = 0
+    self.end = 0
+    # Hasta dónde ya se buscó el terminador sin encontrarlo
+    self.scanned = 0
+    # Posición del terminador de la primera línea, si ya se encontró
+    self.eol = -1
+
+  def __len__(self):
+    return self.end - self.start
+
+  def _reserve(self, size):
+    """
+    Asegura lugar para `size' bytes más al final de los datos.
+    """
+    if self.end + size <= len(self.data):
+      return
+    pending = self.end - self.start
+    if pending + size > len(self.data) // 2:
+      # Crece al doble de lo necesario para amortizar las copias
+      new_data = bytearray(max(2 * (pending + size), len(self.data)))
+      new_data[:pending] = self.data[self.start:self.end]
+      self.data = new_data
+    else:
+      # Alcanza con mover los datos pendientes al principio
+      self.data[:pending] = self.data[self.start:self.end]
+    self.scanned -= self.start
+    if self.eol >= 0:
+      self.eol -= self.start
+    self.start = 0
+    self.end = pending
+
+  def recv_into(self, nsocket: socket, size=RECV_SIZE):
+    """
+    Recibe hasta `size' bytes del socket directamente en el buffer.
+    Devuelve la cantidad recibida; 0 si el otro extremo cerró.
+    """
+    # Se recibe a lo sumo lo que entra: el buffer solo crece si ya está
+    # ocupado en buena parte por una línea incompleta
+    self._reserve(min(size, len(self.data) // 4))
+    size = min(size, len(self.data) - self.end)
+    with memoryview(self.data) as view:
+      with view[self.end:self.end + size] as free:
+        received = nsocket.recv_into(free)
+    self.end += received
+    return received
+
+  def _rewind(self):
+    """
+    Vuelve al principio del buffer, ya vacío. Si creció por una línea
+    larga, recupera el tamaño inicial.
+    """
+    self.start = self.end = self.scanned = 0
+    if len(self.data) > self.size:
+      self.data = bytearray(self.size)
+
+  def feed(self, data: bytes):
+    """
+    Agrega al buffer datos ya recibidos por otro medio.
+    """
+    self._reserve(len(data))
+    self.data[self.end:self.end + len(data)] = data
+    self.end += len(data)
+
+  def has_line(self):
+    """
+    Responde si hay una línea completa, buscando el terminador solo en
+    los datos que llegaron desde la última búsqueda.
+    """
+    if self.eol < 0:
+      # El terminador pudo quedar partido entre dos bloques
+      start = max(self.start, self.scanned - len(EOL_BYTES) + 1)
+      self.eol = self.data.find(EOL_BYTES, start, self.end)
+      if self.eol < 0:
+        self.scanned = self.end
+    return self.eol >= 0
+
+  def take_line(self):
+    """
+    Quita del buffer y devuelve la primera línea, sin el terminador, o
+    None si todavía no está completa.
+    """
+    if not self.has_line():
+      return None
+    line = bytes(self.data[self.start:self.eol])
+    self.start = self.eol + len(EOL_BYTES)
+    self.scanned = self.start
+    self.eol = -1
+    if self.start == self.end:
+      self._rewind()
+    return line
+
+  def take(self, size):
+    """
+    Quita del buffer y devuelve hasta `size' bytes.
+    """
+    size = min(size, len(self))
+    data = bytes(self.data[self.start:self.start + size])
+    self.start += size
+    self.scanned = self.start
+    self.eol = -1
+    if self.start == self.end:
+      self._rewind()
+    return data
@@ -0,0 +1,197 @@
+# encoding: utf-8
+# Métricas del servidor: contadores e histogramas por comando, y valores
+# instantáneos (cola, hilos, cachés) que se leen al consultarlas.
+
+import bisect
+import threading
+from constants import *
+
+
+class Histogram(object):
+  """
+  Histograma de latencias con límites fijos, en segundos. Guarda la
+  cantidad de observaciones de cada intervalo y la suma de todas.
+  """
+
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    # Un intervalo más para lo que supera el último límite
+    self.counts = [0] * (len(bounds) + 1)
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.sum += value
+
+  def cumulative(self):
+    """
+    Devuelve pares (límite, observaciones menores o iguales), con el
+    último límite infinito, como los buckets de Prometheus.
+    """
+    total = 0
+    result = []
+    for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+      total += count
+      result.append((bound, total))
+    return result
+
+  def quantile(self, q):
+    """
+    Estima el cuantil q como el límite del intervalo que lo contiene.
+    """
+    total = sum(self.counts)
+    if total == 0:
+      return None
+    for bound, count in self.cumulative():
+      if count >= q * total:
+        return bound
+
+
+class CommandStats(object):
+  """
+  Contadores de un comando del protocolo.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+    # Código de error -> cantidad
+    self.errors = {}
+    self.latency = Histogram()
+
+
+class Metrics(object):
+  """
+  Métricas del servidor, compartidas por todas sus conexiones. Registrar
+  un evento solo toma un lock y suma contadores.
+
+  Los valores instantáneos, como el largo de la cola de conexiones, se
+  registran como funciones que se llaman recién al consultar.
+  """
+
+  def __init__(self):
+    # Comando -> CommandStats
+    self.commands = {}
+    # Nombre -> función que devuelve el valor actual
+    self.gauges = {}
+    self.connections = 0
+    self.lock = threading.Lock()
+
+  def _command(self, command):
+    stats = self.commands.get(command)
+    if stats is None:
+      stats = self.commands[command] = CommandStats()
+    return stats
+
+  def observe(self, command, latency, bytes_in):
+    """
+    Registra un pedido atendido, con su tiempo de atención en segundos
+    y el largo del pedido.
+    """
+    with self.lock:
+      stats = self._command(command)
+      stats.count += 1
+      stats.bytes_in += bytes_in
+      stats.latency.observe(latency)
+
+  def add_bytes_out(self, command, size):
+    with self.lock:
+      self._command(command).bytes_out += size
+
+  def add_error(self, command, status):
+    with self.lock:
+      errors = self._command(command).errors
+      errors[status] = errors.get(status, 0) + 1
+
+  def add_connections(self, delta):
+    with self.lock:
+      self.connections += delta
+
+  def register_gauge(self, name, function):
+    """
+    Registra un valor instantáneo; `function' se llama sin argumentos al
+    consultar las métricas.
+    """
+    with self.lock:
+      self.gauges[name] = function
+
+  def read_gauges(self):
+    """
+    Devuelve los valores instantáneos actuales, en orden de nombre.
+    """
+    with self.lock:
+      gauges = dict(self.gauges)
+      gauges['connections'] = lambda: self.connections
+    values = []
+    for name in sorted(gauges):
+      try:
+        values.append((name, gauges[name]()))
+      except Exception:
+        # Un valor que no se puede leer no invalida el resto
+        pass
+    return values
+
+  def render_text(self):
+    """
+    Devuelve las métricas como líneas "nombre valor", para el comando
+    stats.
+    """
+    lines = []
+    with self.lock:
+      for command in sorted(self.commands):
+        stats = self.commands[command]
+        prefix = f"command.{command}."
+        lines.append(f"{prefix}count {stats.count}")
+        lines.append(f"{prefix}bytes_in {stats.bytes_in}")
+        lines.append(f"{prefix}bytes_out {stats.bytes_out}")
+        lines.append(f"{prefix}latency_sum {stats.latency.sum:.6f}")
+        for q, name in ((0.5, "p50"), (0.99, "p99"), (0.999, "p999")):
+          lines.append(f"{prefix}latency_{name} {stats.latency.quantile(q)}")
+        for status in sorted(stats.errors):
+          lines.append(f"{prefix}errors.{status} {stats.errors[status]}")
+    for name, value in self.read_gauges():
+      lines.append(f"gauge.{name} {value}")
+    return lines
+
+  def render_prometheus(self):
+    """
+    Devuelve las métricas en el formato de texto de Prometheus. Cada
+    familia va entera a continuación de su línea TYPE, con una muestra
+    por comando.
+    """
+    def counter(attribute):
+      return lambda label, stats: [f"{{{label}}} {getattr(stats, attribute)}"]
+
+    def errors(label, stats):
+      return [f'{{{label},code="{status}"}} {stats.errors[status]}'
+              for status in sorted(stats.errors)]
+
+    def duration(label, stats):
+      samples = []
+      for bound, count in stats.latency.cumulative():
+        le = "+Inf" if bound == float('inf') else repr(bound)
+        samples.append(f'_bucket{{{label},le="{le}"}} {count}')
+      samples.append(f"_sum{{{label}}} {stats.latency.sum:.6f}")
+      samples.append(f"_count{{{label}}} {stats.count}")
+      return samples
+
+    families = (
+        ("hftp_requests_total", "counter", counter('count')),
+        ("hftp_request_bytes_in_total", "counter", counter('bytes_in')),
+        ("hftp_request_bytes_out_total", "counter", counter('bytes_out')),
+        ("hftp_request_errors_total", "counter", errors),
+        ("hftp_request_duration_seconds", "histogram", duration),
+    )
+    lines = []
+    with self.lock:
+      for family, kind, samples in families:
+        lines.append(f"# TYPE {family} {kind}")
+        for command in sorted(self.commands):
+          label = f'command="{command}"'
+          for sample in samples(label, self.commands[command]):
+            lines.append(family + sample)
+    for name, value in self.read_gauges():
+      lines.append(f"# TYPE hftp_{name} gauge")
+      lines.append(f"hftp_{name} {value}")
+    return lines
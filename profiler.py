@@ -0,0 +1,106 @@
+# encoding: utf-8
+# Perfilado bajo demanda del servidor: un hilo muestrea periódicamente
+# las pilas de todos los hilos y guarda las pilas agregadas en el formato
+# "collapsed" de los flamegraphs.
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from constants import *
+
+
+def collapse_stack(frame):
+  """
+  Pila de un hilo como "archivo:función;...", de la base a la cima.
+  """
+  names = []
+  while frame is not None:
+    code = frame.f_code
+    # co_qualname recién existe desde Python 3.11
+    names.append("%s:%s" % (os.path.basename(code.co_filename),
+                            getattr(code, 'co_qualname', code.co_name)))
+    frame = frame.f_back
+  names.reverse()
+  return ";".join(names)
+
+
+class StackSampler(object):
+  """
+  Muestreador de las pilas de todos los hilos del proceso. Mientras no
+  está corriendo no cuesta nada; mientras corre, cada `interval' segundos
+  toma una muestra, y al detenerse (o a los max_seconds) escribe en
+  `directory' un archivo hftp-<pid>-<fecha>.folded con una línea
+  "pila cantidad" por cada pila distinta.
+
+  Los hilos ociosos también aparecen, esperando en su lock.
+  """
+
+  def __init__(self, directory, interval=PROFILE_INTERVAL,
+               max_seconds=PROFILE_MAX_SECONDS):
+    self.directory = directory
+    self.interval = interval
+    self.max_seconds = max_seconds
+    self.thread = None
+    self.stopped = threading.Event()
+    # Archivo de la última captura terminada
+    self.path = None
+
+  def running(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  def start(self):
+    if self.running():
+      return
+    self.stopped.clear()
+    self.thread = threading.Thread(target=self._run, name="hftp-profiler")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self, wait=False):
+    """
+    Detiene la captura. Con wait, espera a que se escriba el archivo y
+    devuelve su nombre.
+    """
+    self.stopped.set()
+    if wait and self.thread is not None:
+      self.thread.join()
+    return self.path
+
+  def toggle(self):
+    """
+    Arranca la captura si no está corriendo, o la detiene si lo está.
+    Se puede llamar desde un manejador de señales: no espera a nadie.
+    """
+    if self.running():
+      self.stop()
+    else:
+      self.start()
+
+  def _run(self):
+    own = threading.get_ident()
+    stacks = Counter()
+    started = time.monotonic()
+    deadline = started + self.max_seconds
+    while not self.stopped.wait(self.interval):
+      for ident, frame in sys._current_frames().items():
+        if ident != own:
+          stacks[collapse_stack(frame)] += 1
+      if time.monotonic() >= deadline:
+        break
+    self.path = self._save(stacks, time.monotonic() - started)
+
+  def _save(self, stacks, elapsed):
+    path = os.path.join(self.directory, "hftp-%d-%s.folded" % (
+        os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+          f.write("%s %d%s" % (stack, count, NEWLINE))
+    except OSError as e:
+      print(f"Could not write profile {path}: {e}")
+      return None
+    print(f"Profile of {elapsed:.1f}s written to {path}.")
+    return path
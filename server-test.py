@@ -9,16 +9,31 @@
 import select
 import unittest
 import client
+import connection
+import dirindex
+import filecache
 import constants
+import linebuffer
+import metrics
+import profiler
+import server
 import socket
 import os
 import os.path
 import logging
 import time
 import sys
+import threading
+import asyncio
+import base64
+import resource
+import subprocess
 
 DATADIR = 'testdata'
 TIMEOUT = 3  # Una cantidad razonable de segundos para esperar respuestas
+# Segundos que puede tardar una respuesta chica (sin esperas de Nagle ni
+# de MSG_MORE, que suman 40 a 200 ms)
+SMALL_REPLY_LATENCY = 0.02
 
 
 class TestBase(unittest.TestCase):
@@ -128,6 +143,94 @@ class TestHFTPServer(TestBase):
         m, 0, "El tamaño reportado para el archivo no es el correcto")
     c.close()
 
+  def test_get_metadata_many(self):
+    names = ['f%d' % i for i in range(500)]
+    for i, name in enumerate(names):
+      with open(os.path.join(DATADIR, name), 'w') as f:
+        f.write('x' * i)
+    c = self.new_client()
+    # Los pedidos van de a muchos sin esperar respuesta, con uno erróneo
+    sizes = c.get_metadata_many(names[:250] + ['nofile'] + names[250:], 64)
+    self.assertEqual(sizes, list(range(250)) + [None] + list(range(250, 500)),
+                     "Los tamaños reportados no son los correctos")
+    self.assertEqual(c.status, constants.CODE_OK)
+    c.close()
+
+  def test_listing_metadata(self):
+    for name, size in (('bar', 10), ('foo', 0), ('x', 12345)):
+      with open(os.path.join(DATADIR, name), 'w') as f:
+        f.write('x' * size)
+    c = self.new_client()
+    files = sorted(c.file_lookup_metadata())
+    self.assertEqual(c.status, constants.CODE_OK)
+    self.assertEqual([(name, size) for name, size, mtime in files],
+                     [('bar', 10), ('foo', 0), ('x', 12345)])
+    for name, size, mtime in files:
+      self.assertEqual(
+          mtime, os.stat(os.path.join(DATADIR, name)).st_mtime_ns)
+    sizes = c.get_sizes(['x', 'nofile', 'bar'])
+    self.assertEqual(c.status, constants.CODE_OK)
+    self.assertEqual(sizes, [12345, None, 10])
+    c.close()
+
+  def assert_fast_reply(self, request):
+    """
+    Verifica que la mediana de varias repeticiones de `request' (que
+    envía un pedido y lee su respuesta) no supere SMALL_REPLY_LATENCY.
+    """
+    request()
+    latencies = []
+    for i in range(9):
+      start = time.perf_counter()
+      request()
+      latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    self.assertLess(latencies[len(latencies) // 2], SMALL_REPLY_LATENCY)
+
+  def test_small_reply_latency(self):
+    with open(os.path.join(DATADIR, 'small'), 'wb') as f:
+      f.write(b'x' * 1000)
+    with open(os.path.join(DATADIR, 'random'), 'wb') as f:
+      f.write(os.urandom(1000))
+    c = self.new_client()
+    self.output_file = 'small'
+    self.assert_fast_reply(lambda: c.get_slice('small', 0, 1000))
+    self.assertEqual(c.status, constants.CODE_OK)
+    self.assert_fast_reply(c.file_lookup_metadata)
+    self.assertEqual(c.status, constants.CODE_OK)
+    # Respuestas "zlib" y "raw" de get_slice_zlib
+    for name in ('small', 'random'):
+      self.assert_fast_reply(lambda: c.get_slice_zlib(name, 0, 1000))
+      self.assertEqual(c.status, constants.CODE_OK)
+    os.remove('random')
+    c.close()
+
+  def test_stats(self):
+    c = self.new_client()
+
+    def read_stats():
+      c.send('stats')
+      c.status, message = c.read_response_line()
+      self.assertEqual(c.status, constants.CODE_OK)
+      stats = {}
+      line = c.read_line()
+      while line:
+        name, value = line.split(' ', 1)
+        stats[name] = value
+        line = c.read_line()
+      return stats
+
+    count = 'command.get_metadata.count'
+    errors = 'command.get_metadata.errors.%d' % constants.FILE_NOT_FOUND
+    before = read_stats()
+    c.get_metadata('nofile')
+    after = read_stats()
+    self.assertEqual(int(after[count]), int(before.get(count, 0)) + 1)
+    self.assertEqual(int(after[errors]), int(before.get(errors, 0)) + 1)
+    self.assertIn('command.get_metadata.latency_p99', after)
+    self.assertIn('gauge.connections', after)
+    c.close()
+
   def test_get_full_slice(self):
     self.output_file = 'bar'
     test_data = 'The quick brown fox jumped over the lazy dog'
@@ -181,6 +284,49 @@ class TestHFTPServer(TestBase):
     f.close()
     c.close()
 
+  def test_get_slice_raw(self):
+    self.output_file = 'bar'
+    test_data = bytes(range(256)) * 4
+    f = open(os.path.join(DATADIR, self.output_file), 'wb')
+    f.write(test_data)
+    f.close()
+    c = self.new_client()
+    c.get_slice_raw(self.output_file, 10, 500)
+    self.assertEqual(c.status, constants.CODE_OK)
+    f = open(self.output_file, 'rb')
+    self.assertEqual(f.read(), test_data[10:510],
+                     "El contenido del archivo no es el correcto")
+    f.close()
+    # La conexión sigue sincronizada luego del fragmento crudo
+    m = c.get_metadata(self.output_file)
+    self.assertEqual(m, len(test_data))
+    c.close()
+
+  def test_get_slice_zlib(self):
+    self.output_file = 'bar'
+    text = b''.join(b'linea %d del log\n' % i for i in range(100000))
+    noise = os.urandom(300000)
+    for name, test_data in (('text', text), ('noise', noise)):
+      with open(os.path.join(DATADIR, name), 'wb') as f:
+        f.write(test_data)
+    c = self.new_client()
+    # Texto comprimido, y datos al azar que se envían sin comprimir
+    for name, test_data, level in (('text', text, 9), ('noise', noise, None)):
+      os.rename(os.path.join(DATADIR, name),
+                os.path.join(DATADIR, self.output_file))
+      c.get_slice_zlib(self.output_file, 5, len(test_data) - 10, level)
+      self.assertEqual(c.status, constants.CODE_OK)
+      with open(self.output_file, 'rb') as f:
+        self.assertEqual(f.read(), test_data[5:-5],
+                         "El contenido del archivo no es el correcto")
+      # La conexión sigue sincronizada luego del fragmento
+      m = c.get_metadata(self.output_file)
+      self.assertEqual(m, len(test_data))
+    c.send('get_slice_zlib bar 0 10 10')
+    status, message = c.read_response_line(TIMEOUT)
+    self.assertEqual(status, constants.INVALID_ARGUMENTS)
+    c.close()
+
 
 class TestHFTPErrors(TestBase):
 
@@ -308,6 +454,194 @@ class TestHFTPHard(TestBase):
     f.close()
     c.close()
 
+  def test_retrieve_parallel(self):
+    self.output_file = 'bar'
+    test_data = os.urandom(3 * 2 ** 20 + 12345)
+    with open(os.path.join(DATADIR, self.output_file), 'wb') as f:
+      f.write(test_data)
+    c = self.new_client()
+    c.retrieve(self.output_file, connections=4, range_size=2 ** 18)
+    self.assertEqual(c.status, constants.CODE_OK)
+    with open(self.output_file, 'rb') as f:
+      self.assertEqual(f.read(), test_data,
+                       "El contenido del archivo no es el correcto")
+    c.close()
+
+  def test_retrieve_parallel_failed(self):
+    self.output_file = 'bar'
+    test_data = os.urandom(2 ** 20 + 12345)
+    with open(os.path.join(DATADIR, self.output_file), 'wb') as f:
+      f.write(test_data)
+    c = self.new_client()
+    # Los trozos más allá del final del archivo fallan con BAD_OFFSET
+    c.retrieve_parallel(self.output_file, 2 ** 21, 4, 2 ** 18)
+    self.assertEqual(c.status, constants.BAD_OFFSET)
+    # Queda solo un principio sin huecos, que resume puede completar
+    with open(self.output_file, 'rb') as f:
+      partial = f.read()
+    self.assertEqual(partial, test_data[:len(partial)])
+    c.retrieve(self.output_file, resume=True)
+    self.assertEqual(c.status, constants.CODE_OK)
+    with open(self.output_file, 'rb') as f:
+      self.assertEqual(f.read(), test_data,
+                       "El contenido del archivo no es el correcto")
+    c.close()
+
+  def test_retrieve_resume(self):
+    self.output_file = 'bar'
+    test_data = os.urandom(2 ** 20 + 7)
+    with open(os.path.join(DATADIR, self.output_file), 'wb') as f:
+      f.write(test_data)
+    # Copia local interrumpida a mitad de camino
+    with open(self.output_file, 'wb') as f:
+      f.write(test_data[:300001])
+    c = self.new_client()
+    c.retrieve(self.output_file, resume=True)
+    self.assertEqual(c.status, constants.CODE_OK)
+    with open(self.output_file, 'rb') as f:
+      self.assertEqual(f.read(), test_data,
+                       "El contenido del archivo no es el correcto")
+    # Una copia local más grande que la del server se baja de nuevo
+    with open(self.output_file, 'ab') as f:
+      f.write(b'x' * 10)
+    c.retrieve(self.output_file, resume=True)
+    with open(self.output_file, 'rb') as f:
+      self.assertEqual(f.read(), test_data,
+                       "El contenido del archivo no es el correcto")
+    c.close()
+
+  def test_async_client(self):
+    test_data = [os.urandom(100000 * i + 1) for i in range(8)]
+    for i, data in enumerate(test_data):
+      with open(os.path.join(DATADIR, 'f%d' % i), 'wb') as f:
+        f.write(data)
+
+    async def session(i):
+      c = await client.AsyncClient.connect()
+      files = await c.file_lookup()
+      # La sesión 0 pide un archivo que no existe
+      await c.retrieve('f%d' % i if i > 0 else 'nofile')
+      status = c.status
+      await c.close()
+      return sorted(files), status
+
+    async def run():
+      return await asyncio.gather(*(session(i) for i in range(8)))
+
+    try:
+      results = asyncio.run(run())
+      self.assertEqual(results[0], (['f%d' % i for i in range(8)],
+                                    constants.FILE_NOT_FOUND))
+      for i in range(1, 8):
+        self.assertEqual(results[i][1], constants.CODE_OK)
+        with open('f%d' % i, 'rb') as f:
+          self.assertEqual(f.read(), test_data[i],
+                           "El contenido del archivo no es el correcto")
+    finally:
+      for i in range(8):
+        if os.path.exists('f%d' % i):
+          os.remove('f%d' % i)
+
+  def test_sync(self):
+    self.output_file = 'bar'
+    block_size = constants.CHECKSUM_BLOCK_SIZE
+    test_data = os.urandom(5 * block_size + block_size // 2)
+    with open(os.path.join(DATADIR, self.output_file), 'wb') as f:
+      f.write(test_data)
+    # Copia local con el bloque 1 cambiado y sin el final
+    local_data = bytearray(test_data[:4 * block_size + 100])
+    local_data[block_size + 10] ^= 0xff
+    with open(self.output_file, 'wb') as f:
+      f.write(local_data)
+    c = self.new_client()
+    try:
+      fetched = c.sync(self.output_file)
+      self.assertEqual(c.status, constants.CODE_OK)
+      self.assertEqual(fetched, block_size + block_size * 3 // 2)
+      with open(self.output_file, 'rb') as f:
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+      # Ya sincronizado, no se pide nada; una copia más larga se recorta
+      with open(self.output_file, 'ab') as f:
+        f.write(b'x' * 10)
+      self.assertEqual(c.sync(self.output_file), 0)
+      with open(self.output_file, 'rb') as f:
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+      c.close()
+    finally:
+      os.system('rm -rf %s%s' % (DATADIR, constants.CHECKSUM_DIR_SUFFIX))
+
+  def test_checksums_pipelined(self):
+    block_size = constants.CHECKSUM_BLOCK_SIZE
+    test_data = os.urandom(3 * block_size)
+    with open(os.path.join(DATADIR, 'bar'), 'wb') as f:
+      f.write(test_data)
+    digests = [client.block_digest(test_data[i:i + block_size]).encode()
+               for i in range(0, len(test_data), block_size)]
+    s = socket.create_connection(('localhost', constants.DEFAULT_PORT))
+    s.settimeout(TIMEOUT)
+    try:
+      # El índice se calcula aparte, pero las respuestas salen en orden
+      s.sendall(b'get_checksums bar\r\nget_metadata bar\r\n'
+                b'get_checksums bar\r\nquit\r\n')
+      received = b''
+      while True:
+        chunk = s.recv(2 ** 16)
+        if not chunk:
+          break
+        received += chunk
+      checksums = [b'0 OK', b'%d %d' % (len(test_data), block_size)] + digests
+      self.assertEqual(received.split(b'\r\n'),
+                       checksums + [b'', b'0 OK', b'%d' % len(test_data)] +
+                       checksums + [b'', b'0 OK', b''])
+      s.close()
+    finally:
+      os.system('rm -rf %s%s' % (DATADIR, constants.CHECKSUM_DIR_SUFFIX))
+
+  def test_client_pool(self):
+    test_size = 1234
+    with open(os.path.join(DATADIR, 'bar'), 'w') as f:
+      f.write('x' * test_size)
+    pool = client.ClientPool(max_idle=2)
+    try:
+      with pool.connection() as c:
+        first = c
+        self.assertEqual(c.get_metadata('bar'), test_size)
+      # La conexión libre se reutiliza
+      with pool.connection() as c:
+        self.assertIs(c, first)
+        c.send('get_metadata bar')
+        c.read_response_line(TIMEOUT)
+        c.read_line(TIMEOUT)
+      # Un timeout en la última lectura no hace esperar ni descartar
+      start = time.time()
+      with pool.connection() as c:
+        self.assertIs(c, first)
+      self.assertLess(time.time() - start, 0.5)
+      # Si el server la cerró, se reemplaza por una nueva
+      with pool.connection() as c:
+        c.send('quit')
+        c.read_response_line(TIMEOUT)
+        time.sleep(0.2)
+      with pool.connection() as c:
+        self.assertIsNot(c, first)
+        self.assertEqual(c.get_metadata('bar'), test_size)
+      # Varios hilos a la vez, cada uno con su conexión
+      sizes = []
+      def fetch():
+        for _ in range(20):
+          with pool.connection() as c:
+            sizes.append(c.get_metadata('bar'))
+      threads = [threading.Thread(target=fetch) for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertEqual(sizes, [test_size] * 80)
+    finally:
+      pool.close()
+
   def test_big_filename(self):
     c = self.new_client()
     c.send('get_metadata ' + 'x' * (5 * 2 ** 20), timeout=120)
@@ -322,6 +656,68 @@ class TestHFTPHard(TestBase):
         status)
     c.close()
 
+  def test_line_buffer(self):
+    buffer = linebuffer.LineBuffer()
+    server_side, client_side = socket.socketpair()
+    line = b'x' * (5 * 2 ** 20)
+    sender = threading.Thread(target=client_side.sendall,
+                              args=(line + b'\r\nquit\r\n',))
+    sender.start()
+    while not buffer.has_line():
+      self.assertGreater(buffer.recv_into(server_side), 0)
+    self.assertEqual(buffer.take_line(), line)
+    while not buffer.has_line():
+      self.assertGreater(buffer.recv_into(server_side), 0)
+    self.assertEqual(buffer.take_line(), b'quit')
+    # Vacío, vuelve al tamaño inicial
+    self.assertEqual(len(buffer.data), constants.RECV_BUFFER_SIZE)
+    sender.join(TIMEOUT)
+    # Con un tamaño inicial mayor, un bloque entero llega de una vez
+    buffer = linebuffer.LineBuffer(constants.RECV_SIZE)
+    client_side.sendall(b'x' * constants.RECV_SIZE)
+    self.assertEqual(buffer.recv_into(server_side, constants.RECV_SIZE),
+                     constants.RECV_SIZE)
+    server_side.close()
+    client_side.close()
+
+  def test_file_cache_limit(self):
+    paths = [os.path.join(DATADIR, name) for name in ('a', 'b', 'c')]
+    for path in paths:
+      with open(path, 'wb') as f:
+        f.truncate(2 ** 31)
+    cache = filecache.FileCache(max_files=2)
+    first = cache.get(paths[0])
+    # El tamaño de los archivos no cuenta, solo los descriptores
+    self.assertIs(cache.get(paths[1]), cache.get(paths[1]))
+    self.assertIs(cache.get(paths[0]), first)
+    cache.get(paths[2])
+    self.assertEqual(list(cache.entries), [paths[0], paths[2]])
+
+  def test_stat_race(self):
+    if not dirindex.inotify_available():
+      self.skipTest("inotify no está disponible")
+    path = os.path.join(DATADIR, 'bar')
+    with open(path, 'wb') as f:
+      f.write(b'x')
+    index = dirindex.DirIndex(DATADIR)
+    self.assertTrue(index.contains('bar'))
+    file_identity = dirindex.file_identity
+
+    def modified_meanwhile(st):
+      # Mientras el stat corre fuera del lock, el archivo cambia y otro
+      # hilo consume el evento
+      with open(path, 'ab') as f:
+        f.write(b'yy')
+      index.contains('bar')
+      return file_identity(st)
+    dirindex.file_identity = modified_meanwhile
+    try:
+      self.assertEqual(index.stat('bar')[2], 1)
+    finally:
+      dirindex.file_identity = file_identity
+    # El stat viejo no quedó guardado
+    self.assertEqual(index.stat('bar')[2], 3)
+
   def test_data_with_nulls(self):
     self.output_file = 'bar'
     test_data = 'x' * 100 + '\0' * 100 + 'y' * 100
@@ -351,6 +747,241 @@ class TestHFTPHard(TestBase):
                      "La lista de 1000 archivos no es la correcta")
     c.close()
 
+  def test_prometheus_families(self):
+    stats = metrics.Metrics()
+    for command in ('get_metadata', 'get_slice'):
+      stats.observe(command, 0.001, 20)
+      stats.add_error(command, constants.FILE_NOT_FOUND)
+    stats.register_gauge('queue_depth', lambda: 0)
+    # Cada familia va junta, inmediatamente después de su línea TYPE
+    families = []
+    for line in stats.render_prometheus():
+      if line.startswith('# TYPE '):
+        families.append(line.split()[2])
+        continue
+      name = line.split('{')[0].split()[0]
+      self.assertTrue(name.startswith(families[-1]), line)
+    self.assertEqual(len(families), len(set(families)))
+    self.assertIn('hftp_request_duration_seconds', families)
+
+  def test_profiler(self):
+    done = threading.Event()
+
+    def busy_loop():
+      while not done.is_set():
+        sum(range(1000))
+
+    thr = threading.Thread(target=busy_loop)
+    thr.start()
+    sampler = profiler.StackSampler(DATADIR, interval=0.001)
+    sampler.start()
+    time.sleep(0.2)
+    path = sampler.stop(wait=True)
+    done.set()
+    thr.join()
+    self.assertFalse(sampler.running())
+    with open(path) as f:
+      lines = f.read().splitlines()
+    self.assertTrue(lines)
+    for line in lines:
+      stack, count = line.rsplit(' ', 1)
+      self.assertGreater(int(count), 0)
+    self.assertTrue(any('busy_loop' in line for line in lines))
+
+  def test_reaper(self):
+    reaper = connection.Reaper(idle_timeout=0.2, command_timeout=0.2,
+                               interval=0.05)
+    reaper.start()
+    for request in (b'', b'get_metadata fo'):
+      server_side, client_side = socket.socketpair()
+      conn = connection.Connection(server_side, DATADIR)
+      reaper.add(conn)
+      thr = threading.Thread(target=conn.handle)
+      thr.start()
+      # Un cliente ocioso, o que no termina su pedido, libera el hilo
+      client_side.sendall(request)
+      client_side.settimeout(TIMEOUT)
+      self.assertEqual(client_side.recv(1024), b'')
+      thr.join(TIMEOUT)
+      self.assertFalse(thr.is_alive())
+      reaper.remove(conn)
+      server_side.close()
+      client_side.close()
+    self.assertEqual(reaper.reaped, 2)
+
+  def test_thread_pool(self):
+    release = threading.Event()
+
+    def handle(nw_socket, client_info):
+      release.wait(TIMEOUT)
+
+    def wait_until(condition):
+      deadline = time.monotonic() + TIMEOUT
+      while not condition():
+        self.assertLess(time.monotonic(), deadline)
+        time.sleep(0.01)
+
+    pool = server.ThreadPool(handle, min_workers=1, max_workers=2,
+                             max_queued=1, queue_timeout=0.2,
+                             idle_timeout=0.2)
+    pool.start()
+    wait_until(lambda: pool.idle == 1)
+    pairs = [socket.socketpair() for i in range(4)]
+    # La primera conexión la toma el hilo mínimo; la segunda agrega uno
+    self.assertTrue(pool.submit(pairs[0][0], ('a', 0)))
+    wait_until(lambda: pool.idle == 0 and not pool.pending)
+    self.assertTrue(pool.submit(pairs[1][0], ('b', 0)))
+    self.assertEqual(pool.workers, 2)
+    wait_until(lambda: pool.idle == 0 and not pool.pending)
+    # Sin hilos de sobra, una conexión espera en la cola y la siguiente
+    # se rechaza con SERVER_BUSY
+    self.assertTrue(pool.submit(pairs[2][0], ('c', 0)))
+    self.assertFalse(pool.submit(pairs[3][0], ('d', 0)))
+    srv = server.Server(directory=DATADIR)
+    srv.socket.close()
+    srv.refuse(pairs[3][0], ('d', 0))
+    pairs[3][1].settimeout(TIMEOUT)
+    self.assertTrue(
+        pairs[3][1].recv(1024).startswith(b'102 SERVER BUSY\r\n'))
+    # La encolada vence al pasar queue_timeout
+    time.sleep(0.3)
+    self.assertEqual(pool.expire(), [(pairs[2][0], ('c', 0))])
+    # Liberados, los hilos de más se retiran al quedar ociosos
+    release.set()
+    wait_until(lambda: pool.workers == 1)
+    for server_side, client_side in pairs:
+      server_side.close()
+      client_side.close()
+
+  def test_reaper_slow_reader(self):
+    data = os.urandom(2 ** 22)
+    with open(os.path.join(DATADIR, 'big'), 'wb') as f:
+      f.write(data)
+    reaper = connection.Reaper(idle_timeout=TIMEOUT, command_timeout=0.5,
+                               interval=0.05)
+    reaper.start()
+    server_side, client_side = socket.socketpair()
+    conn = connection.Connection(server_side, DATADIR)
+    reaper.add(conn)
+    thr = threading.Thread(target=conn.handle)
+    thr.start()
+    client_side.sendall(b'get_slice_raw big 0 %d\r\nquit\r\n' % len(data))
+    client_side.settimeout(TIMEOUT)
+    expected = b'0 OK\r\n' + data + b'0 OK\r\n'
+    received = bytearray()
+    started = time.monotonic()
+    # Un cliente lento (2 MB/s) pero que avanza no vence, aunque tarde
+    # en recibir todo más que command_timeout
+    while len(received) < len(expected):
+      chunk = client_side.recv(2 ** 16)
+      self.assertTrue(chunk)
+      received += chunk
+      time.sleep(max(len(received) / 2 ** 21 - (time.monotonic() - started), 0))
+    self.assertEqual(bytes(received), expected)
+    self.assertEqual(reaper.reaped, 0)
+    thr.join(TIMEOUT)
+    reaper.remove(conn)
+    server_side.close()
+    client_side.close()
+
+  def assert_survives_fd_limit(self, mode):
+    """
+    Lanza un server aparte en el modo dado, con pocos descriptores de
+    archivo, lo satura de conexiones y verifica que sigue atendiendo
+    una vez que se liberan.
+    """
+    port = constants.DEFAULT_PORT + 1
+    server = subprocess.Popen(
+        [sys.executable,
+         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+         '-m', mode, '-p', str(port), '-d', DATADIR],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        preexec_fn=lambda: resource.setrlimit(resource.RLIMIT_NOFILE,
+                                              (40, 40)))
+    try:
+      deadline = time.monotonic() + TIMEOUT
+      while True:
+        try:
+          socket.create_connection(('localhost', port)).close()
+          break
+        except ConnectionRefusedError:
+          self.assertLess(time.monotonic(), deadline)
+          time.sleep(0.05)
+      sockets = [socket.create_connection(('localhost', port))
+                 for i in range(60)]
+      time.sleep(0.5)
+      self.assertIsNone(server.poll(), "El server murió sin descriptores")
+      for s in sockets:
+        s.close()
+      time.sleep(constants.ACCEPT_RETRY_DELAY + 0.5)
+      c = client.Client(port=port)
+      c.file_lookup()
+      self.assertEqual(c.status, constants.CODE_OK)
+      c.close()
+    finally:
+      server.terminate()
+      server.wait()
+
+  def test_fd_limit(self):
+    for mode in ('threads', 'selectors', 'asyncio'):
+      self.assert_survives_fd_limit(mode)
+
+  def test_rate_limit(self):
+    data = os.urandom(2 ** 20)
+    with open(os.path.join(DATADIR, 'big'), 'wb') as f:
+      f.write(data)
+    rate = 2 ** 21
+    connection.shaper.configure(0, rate)
+    try:
+      for request, expected in (
+          (b'get_slice_raw big 0 %d\r\n' % len(data), data),
+          (b'get_slice big 0 %d\r\n' % len(data),
+           base64.b64encode(data) + b'\r\n')):
+        server_side, client_side = socket.socketpair()
+        conn = connection.Connection(server_side, DATADIR)
+        thr = threading.Thread(target=conn.handle)
+        thr.start()
+        started = time.monotonic()
+        client_side.sendall(request + b'quit\r\n')
+        expected = b'0 OK\r\n' + expected + b'0 OK\r\n'
+        received = bytearray()
+        while len(received) < len(expected):
+          chunk = client_side.recv(2 ** 20)
+          self.assertTrue(chunk)
+          received += chunk
+        elapsed = time.monotonic() - started
+        self.assertEqual(bytes(received), expected)
+        # Lo que supera la ráfaga inicial sale a la tasa pedida
+        burst = connection.shaper.connection_bucket().burst
+        self.assertGreater(elapsed, (len(expected) - burst) / rate * 0.8)
+        client_side.close()
+        thr.join(TIMEOUT)
+        server_side.close()
+    finally:
+      connection.shaper.configure(0, 0)
+
+  def test_truncated_file(self):
+    path = os.path.join(DATADIR, 'big')
+    size = 2 ** 25
+    with open(path, 'wb') as f:
+      f.write(os.urandom(size))
+    s = socket.create_connection(('localhost', constants.DEFAULT_PORT))
+    s.settimeout(TIMEOUT)
+    s.sendall(b'get_slice big 0 %d\r\nquit\r\n' % size)
+    received = len(s.recv(2 ** 16))
+    # Truncarlo a mitad de la descarga corta solo esa conexión
+    os.truncate(path, 1000)
+    while True:
+      chunk = s.recv(2 ** 20)
+      if not chunk:
+        break
+      received += len(chunk)
+    s.close()
+    self.assertLess(received, connection.b64_length(size))
+    c = self.new_client()
+    self.assertEqual(c.file_lookup(), ['big'])
+    self.assertEqual(c.status, constants.CODE_OK)
+
 
 def suite():
   suite = unittest.TestSuite()
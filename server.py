@@ -6,13 +6,133 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: server.py 656 2013-03-18 23:49:11Z bc $
 
+import os
 import sys
+import time
 import optparse
 import socket
+import asyncio
+import selectors
 import connection
+import dirindex
+import profiler
 from constants import *
 import threading
-from queue import Queue
+import signal
+import http.server
+import tempfile
+import heapq
+import traceback
+from collections import deque
+
+
+class ThreadPool(object):
+  """
+  Pool elástico de hilos que atienden conexiones encoladas. Siempre hay
+  al menos min_workers hilos; se agregan hasta max_workers cuando no
+  hay hilos libres y se retiran los que quedan ociosos.
+  """
+
+  def __init__(self, handler, min_workers, max_workers, max_queued,
+               queue_timeout, idle_timeout=WORKER_IDLE_TIMEOUT):
+    # Función que atiende una conexión: handler(nw_socket, client_info)
+    self.handler = handler
+    self.min_workers = min_workers
+    self.max_workers = max_workers
+    self.max_queued = max_queued
+    self.queue_timeout = queue_timeout
+    self.idle_timeout = idle_timeout
+    # Cola de conexiones: (nw_socket, client_info, momento de llegada)
+    self.pending = deque()
+    self.lock = threading.Condition()
+    # Hilos vivos y, de ellos, los que esperan una conexión
+    self.workers = 0
+    self.idle = 0
+
+  def start(self):
+    """
+    Lanza los hilos mínimos del pool.
+    """
+    with self.lock:
+      for i in range(self.min_workers):
+        self._spawn()
+
+  def _spawn(self):
+    """
+    Lanza un hilo nuevo. Se llama con el lock tomado.
+    """
+    self.workers += 1
+    thr = threading.Thread(target=self._work)
+    # Hilo termina cuando el programa termina
+    thr.daemon = True
+    thr.start()
+
+  def submit(self, nw_socket, client_info):
+    """
+    Encola una conexión para que la atienda un hilo, creando uno si
+    hace falta. Devuelve False si el servidor está saturado.
+    """
+    with self.lock:
+      if len(self.pending) >= self.idle:
+        if self.workers < self.max_workers:
+          self._spawn()
+        elif len(self.pending) >= self.max_queued:
+          return False
+      self.pending.append((nw_socket, client_info, time.monotonic()))
+      self.lock.notify()
+    return True
+
+  def expire(self):
+    """
+    Quita de la cola y devuelve las conexiones que esperaron más de
+    queue_timeout segundos.
+    """
+    expired = []
+    deadline = time.monotonic() - self.queue_timeout
+    with self.lock:
+      while self.pending and self.pending[0][2] < deadline:
+        nw_socket, client_info, arrival = self.pending.popleft()
+        expired.append((nw_socket, client_info))
+    return expired
+
+  def _work(self):
+    """
+    Loop de cada hilo: atiende conexiones de la cola hasta quedar ocioso
+    más de idle_timeout segundos con hilos de sobra.
+    """
+    while True:
+      with self.lock:
+        self.idle += 1
+        while not self.pending:
+          if (not self.lock.wait(self.idle_timeout) and not self.pending
+                  and self.workers > self.min_workers):
+            self.idle -= 1
+            self.workers -= 1
+            return
+        self.idle -= 1
+        nw_socket, client_info, arrival = self.pending.popleft()
+      self.handler(nw_socket, client_info)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+  """
+  Responde las métricas del servidor en el formato de Prometheus.
+  """
+
+  def do_GET(self):
+    if self.path not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = ("\n".join(connection.metrics.render_prometheus()) + "\n").encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # Los pedidos de métricas no se registran
+    pass
 
 
 class Server(object):
@@ -21,69 +141,463 @@ class Server(object):
   especificados donde se reciben nuevas conexiones de clientes.
   """
 
-  def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT, directory=DEFAULT_DIR):
+  def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT, directory=DEFAULT_DIR,
+               backlog=LISTEN_BACKLOG, min_workers=MIN_WORKERS,
+               max_workers=MAX_WORKERS, max_queued=MAX_QUEUED,
+               queue_timeout=QUEUE_TIMEOUT, stat_ttl=STAT_CACHE_TTL,
+               nodelay=False, metrics_port=0, profile_dir=None,
+               idle_timeout=IDLE_TIMEOUT, command_timeout=COMMAND_TIMEOUT,
+               rate=0, connection_rate=0):
     # Creación y configuración del socket
     print(f"Serving {directory} on {addr}:{port}.")
     # Dirección y puerto donde escuchar, + directorio
     self.host = addr
     self.port = port
     self.directory = directory
+    # Conexiones pendientes de aceptar por el kernel
+    self.backlog = backlog
+    # Configuración del pool de hilos y de su cola
+    self.min_workers = min_workers
+    self.max_workers = max_workers
+    self.max_queued = max_queued
+    self.queue_timeout = queue_timeout
+    # Segundos de validez de los stat cacheados, si no hay inotify
+    self.stat_ttl = stat_ttl
+    # Desactivar Nagle en las conexiones aceptadas (TCP_NODELAY)
+    self.nodelay = nodelay
+    # Puerto local de las métricas para Prometheus; 0 lo desactiva
+    self.metrics_port = metrics_port
+    # Directorio donde se guardan las capturas de SIGUSR1
+    self.profile_dir = profile_dir or tempfile.gettempdir()
+    # Plazos de las conexiones: sin pedidos, y para completar cada pedido
+    # o aceptar cada parte de una respuesta
+    self.idle_timeout = idle_timeout
+    self.command_timeout = command_timeout
+    # Bytes por segundo de las descargas, en total y por conexión; 0 no
+    # limita
+    self.rate = rate
+    self.connection_rate = connection_rate
     # Se crea el socket para enlazar la conexión
-    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket = self.new_socket()
+
+  def new_socket(self, reuse_port=False):
+    """
+    Crea el socket de escucha del servidor, todavía sin enlazar.
+    Con reuse_port, varios procesos pueden enlazar el mismo puerto y el
+    kernel reparte las conexiones entrantes entre ellos.
+    """
+    # El protocolo explícito hace que asyncio active TCP_NODELAY en sus
+    # transportes (solo lo hace si sock.proto es IPPROTO_TCP): sus
+    # respuestas salen en varias escrituras, que con Nagle esperarían el
+    # ACK demorado del cliente
+    nw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                              socket.IPPROTO_TCP)
     # Se configura el socket para que no espere a que una conexión
     # para volver a ser utilizado
-    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    nw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+      nw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    return nw_socket
+
+  def setup_client(self, nw_socket):
+    """
+    Configura el socket de una conexión recién aceptada. Las respuestas
+    ya salen enteras en un único sendmsg, así que con nodelay no se
+    espera a completar un segmento para enviar la última parte.
+    """
+    if self.nodelay:
+      nw_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def run(self, mode=DEFAULT_MODE):
+    """
+    Atiende clientes con el modo indicado, uno de SERVE_MODES.
+    """
+    # El índice del directorio se crea en el proceso que atiende, para
+    # no compartir el descriptor de inotify entre workers
+    dirindex.get_index(self.directory, stat_ttl=self.stat_ttl)
+    # Las conexiones vencidas se cierran desde un único lugar
+    self.reaper = connection.Reaper(self.idle_timeout, self.command_timeout)
+    connection.metrics.register_gauge('connections_reaped',
+                                      lambda: self.reaper.reaped)
+    connection.shaper.configure(self.rate, self.connection_rate)
+    if self.metrics_port:
+      self.serve_metrics()
+    self.install_profiler()
+    if mode == 'asyncio':
+      self.serve_asyncio()
+    elif mode == 'selectors':
+      self.serve_selectors()
+    else:
+      self.serve()
+
+  def install_profiler(self):
+    """
+    Cada SIGUSR1 arranca o detiene un muestreo de las pilas de todos los
+    hilos, que al terminar se guarda en profile_dir.
+    """
+    sampler = profiler.StackSampler(self.profile_dir)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: sampler.toggle())
+
+  def serve_metrics(self):
+    """
+    Atiende en un hilo aparte, en un puerto local, los pedidos HTTP de
+    las métricas en el formato de Prometheus.
+    """
+    metrics_server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', self.metrics_port), MetricsHandler)
+    metrics_server.daemon_threads = True
+    thr = threading.Thread(target=metrics_server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    print(f"Serving metrics on 127.0.0.1:{self.metrics_port}.")
 
   def serve(self):
     """
-    Loop principal del servidor. Se acepta una conexión a la vez
-    y se espera a que concluya antes de seguir.
+    Loop principal del servidor. Cada conexión aceptada se encola y la
+    atiende un hilo del pool, que crece con la carga hasta max_workers.
+    Si no hay lugar en la cola, o la conexión espera más de
+    queue_timeout, se la rechaza con SERVER_BUSY.
     """
     # Comienza escucha del socket
-    # Solo puede atender a MAX_CLIENT clientes en simultáneo
     self.socket.bind((self.host, self.port))
-    self.socket.listen(MAX_CLIENT)
-
-    # Grupo de hilos
-    threads = []
-    # Cola de conexiones
-    connection_queue = Queue()
+    self.socket.listen(self.backlog)
+    # El accept despierta periódicamente para vencer conexiones encoladas
+    self.socket.settimeout(ADMISSION_CHECK_INTERVAL)
 
-    # Procesa conexiones entrantes
-    def handle():
-      while True:
-        # Obtiene una conexión de la cola
-        nw_socket, client_info = connection_queue.get()
-        print(f"Connection from {client_info[0]} using port {client_info[1]}")
-        # Creo la conexión con el cliente
-        new_connection = connection.Connection(nw_socket, self.directory)
+    # Procesa una conexión entrante
+    def handle(nw_socket, client_info):
+      print(f"Connection from {client_info[0]} using port {client_info[1]}")
+      # Creo la conexión con el cliente
+      new_connection = connection.Connection(nw_socket, self.directory)
+      self.reaper.add(new_connection)
+      connection.metrics.add_connections(1)
+      try:
         # Procesa pedidos del cliente
         new_connection.handle()
+      except OSError as e:
+        print(f"Connection from {client_info[0]} using port {client_info[1]} "
+              f"aborted: {e}")
+      finally:
         # Cierra conexión luego de procesar los pedidos
+        self.reaper.remove(new_connection)
         nw_socket.close()
-        print(
-            f"Connection from {client_info[0]} using port {client_info[1]} closed.")
-        # Indica que la conexión fue procesada, da a lugar a otra conexión
-        connection_queue.task_done()
-
-    # Crea los hilos para la cantidad de clientes máxima
-    for i in range(MAX_CLIENT):
-      # Cada hilo ejecuta la función handle
-      thr = threading.Thread(target=handle)
-      # Hilo termina cuando el programa termina
-      thr.daemon = True
-      # Inicia el hilo
-      thr.start()
-      # Agrega el hilo a la lista de hilos
-      threads.append(thr)
-
-    # Espera a que se procesen todas las conexiones
+        connection.metrics.add_connections(-1)
+      print(
+          f"Connection from {client_info[0]} using port {client_info[1]} closed.")
+
+    pool = ThreadPool(handle, self.min_workers, self.max_workers,
+                      self.max_queued, self.queue_timeout)
+    connection.metrics.register_gauge('queue_depth', lambda: len(pool.pending))
+    connection.metrics.register_gauge('workers_busy',
+                                      lambda: pool.workers - pool.idle)
+    connection.metrics.register_gauge('workers_idle', lambda: pool.idle)
+    pool.start()
+    self.reaper.start()
+
+    while True:
+      try:
+        # Acepta una conexión
+        nw_socket, client_info = self.socket.accept()
+      except socket.timeout:
+        nw_socket = None
+      except ConnectionError:
+        # El cliente se fue antes de ser aceptado
+        nw_socket = None
+      except OSError as e:
+        # Sin descriptores u otros recursos: se espera un rato antes de
+        # reintentar, en lugar de terminar el servidor
+        print(f"Could not accept connections: {e}")
+        nw_socket = None
+        time.sleep(ACCEPT_RETRY_DELAY)
+      if nw_socket is not None:
+        try:
+          self.setup_client(nw_socket)
+        except OSError:
+          nw_socket.close()
+        else:
+          # Agrega la conexión a la cola para que sea procesada por el pool
+          if not pool.submit(nw_socket, client_info):
+            self.refuse(nw_socket, client_info)
+      for nw_socket, client_info in pool.expire():
+        self.refuse(nw_socket, client_info)
+
+  def refuse(self, nw_socket, client_info):
+    """
+    Rechaza una conexión que no pudo ser atendida por falta de hilos.
+    """
+    print(f"Connection from {client_info[0]} using port {client_info[1]} "
+          f"refused: server busy.")
+    try:
+      nw_socket.settimeout(ADMISSION_CHECK_INTERVAL)
+      connection.Connection(nw_socket, self.directory).refuse(SERVER_BUSY)
+    except OSError:
+      pass
+    finally:
+      nw_socket.close()
+
+  def serve_asyncio(self):
+    """
+    Loop principal del servidor usando asyncio. Todas las conexiones se
+    atienden en un único hilo, por lo que la cantidad de clientes en
+    simultáneo no está limitada por la cantidad de hilos.
+    """
+    self.socket.bind((self.host, self.port))
+    self.socket.setblocking(False)
+    asyncio.run(self._serve_asyncio())
+
+  async def _serve_asyncio(self):
+    """
+    Corrutina que acepta conexiones y lanza una tarea por cliente.
+    """
+    # Procesa cada conexión entrante en su propia tarea
+    async def handle(reader, writer):
+      client_info = writer.get_extra_info('peername')
+      print(f"Connection from {client_info[0]} using port {client_info[1]}")
+      new_connection = connection.AsyncConnection(
+          reader, writer, self.directory)
+      self.reaper.add(new_connection)
+      connection.metrics.add_connections(1)
+      try:
+        await new_connection.handle()
+      finally:
+        self.reaper.remove(new_connection)
+        writer.close()
+        connection.metrics.add_connections(-1)
+      print(
+          f"Connection from {client_info[0]} using port {client_info[1]} closed.")
+
+    # Revisa periódicamente los plazos de las conexiones
+    async def reap():
+      while True:
+        await asyncio.sleep(self.reaper.interval)
+        self.reaper.reap()
+
+    # Se guarda la tarea para que no la libere el recolector de basura
+    reaper_task = asyncio.create_task(reap())
+    server = await asyncio.start_server(
+        handle, sock=self.socket, backlog=self.backlog)
+    async with server:
+      await server.serve_forever()
+
+  def serve_selectors(self):
+    """
+    Loop principal del servidor como reactor de selectors. Un único hilo
+    atiende todas las conexiones; un cliente lento solo ocupa su cola
+    de salida, no un hilo.
+    """
+    self.socket.bind((self.host, self.port))
+    self.socket.listen(self.backlog)
+    self.socket.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    # El socket de escucha se distingue por no tener conexión asociada
+    selector.register(self.socket, selectors.EVENT_READ, None)
+    next_reap = time.monotonic() + self.reaper.interval
+    # Conexiones pausadas por ancho de banda: (resume_at, fd, socket, data)
+    self.paused = []
+    # Conexiones que esperan una respuesta calculada en background:
+    # conexión -> (socket, data). Al terminar, el hilo que la calculó la
+    # anota en ready y despierta al reactor escribiendo en wakeup
+    self.waiting = {}
+    ready = deque()
+    wakeup, wakeup_writer = socket.socketpair()
+    wakeup.setblocking(False)
+    wakeup_writer.setblocking(False)
+    selector.register(wakeup, selectors.EVENT_READ, None)
+
+    def notify(new_connection):
+      ready.append(new_connection)
+      try:
+        wakeup_writer.send(b'\0')
+      except BlockingIOError:
+        pass  # Ya hay avisos pendientes
+
+    # Momento en que se vuelve a aceptar conexiones tras un error
+    accept_at = None
+
     while True:
-      # Acepta una conexión
-      nw_socket, client_info = self.socket.accept()
-      # Agrega la conexión a la cola para que sea procesada
-      # por un hilo en handle()
-      connection_queue.put((nw_socket, client_info))
+      timeout = self.reaper.interval
+      if self.paused:
+        timeout = min(timeout, max(self.paused[0][0] - time.monotonic(), 0))
+      if accept_at is not None:
+        timeout = min(timeout, max(accept_at - time.monotonic(), 0))
+      for key, mask in selector.select(timeout):
+        if key.fileobj is wakeup:
+          try:
+            while wakeup.recv(4096):
+              pass
+          except BlockingIOError:
+            pass
+          # Retoma las conexiones cuya respuesta ya se calculó
+          while ready:
+            data = self.waiting.pop(ready.popleft(), None)
+            if data is not None:
+              selector.register(data[0], selectors.EVENT_WRITE, data[1])
+              data[1][0].advance()
+              self._reactor_update(selector, data[0])
+        elif key.data is None:
+          # Acepta todas las conexiones pendientes
+          while True:
+            try:
+              nw_socket, client_info = self.socket.accept()
+            except BlockingIOError:
+              break
+            except ConnectionError:
+              # El cliente se fue antes de ser aceptado
+              continue
+            except OSError as e:
+              # Sin descriptores u otros recursos: se deja de vigilar el
+              # socket de escucha por un rato, en lugar de reintentar ya
+              print(f"Could not accept connections: {e}")
+              selector.unregister(self.socket)
+              accept_at = time.monotonic() + ACCEPT_RETRY_DELAY
+              break
+            try:
+              self.setup_client(nw_socket)
+            except OSError:
+              nw_socket.close()
+              continue
+            print(
+                f"Connection from {client_info[0]} using port {client_info[1]}")
+            new_connection = connection.ReactorConnection(
+                nw_socket, self.directory, notify)
+            self.reaper.add(new_connection)
+            connection.metrics.add_connections(1)
+            new_connection.start()
+            selector.register(nw_socket, selectors.EVENT_READ,
+                              (new_connection, client_info))
+            self._reactor_update(selector, nw_socket)
+        else:
+          key.data[0].handle_event(mask)
+          self._reactor_update(selector, key.fileobj)
+      # Retoma las conexiones pausadas que ya tienen ancho de banda
+      while self.paused and self.paused[0][0] <= time.monotonic():
+        resume_at, fd, nw_socket, data = heapq.heappop(self.paused)
+        selector.register(nw_socket, selectors.EVENT_WRITE, data)
+        data[0].advance()
+        self._reactor_update(selector, nw_socket)
+      if accept_at is not None and time.monotonic() >= accept_at:
+        selector.register(self.socket, selectors.EVENT_READ, None)
+        accept_at = None
+      # Cierra las conexiones vencidas
+      if time.monotonic() >= next_reap:
+        for expired in self.reaper.reap():
+          self._reactor_update(selector, expired.socket)
+        next_reap = time.monotonic() + self.reaper.interval
+
+  def _reactor_update(self, selector, nw_socket):
+    """
+    Ajusta los eventos esperados por una conexión del reactor, o la
+    cierra si ya terminó.
+    """
+    key = selector.get_key(nw_socket)
+    new_connection, client_info = key.data
+    events = new_connection.events()
+    if events == 0:
+      self.reaper.remove(new_connection)
+      selector.unregister(nw_socket)
+      nw_socket.close()
+      connection.metrics.add_connections(-1)
+      print(
+          f"Connection from {client_info[0]} using port {client_info[1]} closed.")
+    elif new_connection.resume_at is not None:
+      # Sin ancho de banda: no se vigila el socket hasta que se renueve
+      selector.unregister(nw_socket)
+      heapq.heappush(self.paused, (new_connection.resume_at,
+                                   nw_socket.fileno(), nw_socket, key.data))
+    elif new_connection.waiting:
+      # No se vigila el socket hasta que se calcule la respuesta
+      selector.unregister(nw_socket)
+      self.waiting[new_connection] = (nw_socket, key.data)
+    elif events != key.events:
+      selector.modify(nw_socket, events, key.data)
+
+  def serve_workers(self, workers, mode=DEFAULT_MODE):
+    """
+    Lanza `workers' procesos, cada uno con su propio socket enlazado al
+    mismo puerto con SO_REUSEPORT y atendiendo clientes con el modo
+    indicado. El proceso original queda como supervisor y reinicia los
+    workers que terminan; si uno falla al arrancar WORKER_MAX_FAILURES
+    veces seguidas, termina a todos y sale con error.
+
+    Cada worker lleva sus propias métricas: si están activadas, el worker
+    i las sirve en metrics_port + i. El límite global de ancho de banda
+    se reparte en partes iguales entre los workers.
+    """
+    # El supervisor no atiende clientes
+    self.socket.close()
+    # Workers vivos: pid -> (momento en que se lanzó, número de worker)
+    children = {}
+    metrics_port = self.metrics_port
+
+    def spawn(index):
+      pid = os.fork()
+      if pid == 0:
+        # Proceso worker: nunca vuelve al loop del supervisor
+        status = 1
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        try:
+          self.socket = self.new_socket(reuse_port=True)
+          if metrics_port:
+            self.metrics_port = metrics_port + index
+          # El límite global se reparte entre los workers
+          self.rate /= workers
+          self.run(mode)
+        except KeyboardInterrupt:
+          status = 0
+        except Exception:
+          traceback.print_exc()
+        finally:
+          # os._exit no vacía los buffers de salida
+          sys.stdout.flush()
+          sys.stderr.flush()
+          os._exit(status)
+      children[pid] = (time.monotonic(), index)
+      print(f"Worker {pid} started.")
+
+    # SIGTERM al supervisor termina también a los workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # SIGUSR1 al supervisor perfila todos los workers
+    def forward(signum, frame):
+      for pid in children:
+        try:
+          os.kill(pid, signum)
+        except ProcessLookupError:
+          pass
+    signal.signal(signal.SIGUSR1, forward)
+    for i in range(workers):
+      spawn(i)
+
+    # Fallos seguidos al arrancar de cada worker
+    failures = [0] * workers
+    try:
+      while True:
+        pid, status = os.wait()
+        started, index = children.pop(pid)
+        status = os.waitstatus_to_exitcode(status)
+        if time.monotonic() - started < WORKER_RESTART_DELAY:
+          failures[index] += 1
+        else:
+          failures[index] = 0
+        if failures[index] >= WORKER_MAX_FAILURES:
+          print(f"Worker {pid} exited with status {status}, failed "
+                f"{failures[index]} times in a row; giving up.")
+          break
+        print(f"Worker {pid} exited with status {status}, restarting.")
+        # Evita relanzar en loop un worker que falla al arrancar
+        if failures[index] > 0:
+          time.sleep(WORKER_RESTART_DELAY)
+        spawn(index)
+    except (KeyboardInterrupt, SystemExit):
+      pass
+    for pid in children:
+      os.kill(pid, signal.SIGTERM)
+    for pid in children:
+      os.waitpid(pid, 0)
+    if max(failures) >= WORKER_MAX_FAILURES:
+      sys.exit(1)
 
 
 def main():
@@ -99,6 +613,63 @@ def main():
   parser.add_option(
       "-d", "--datadir",
       help="Directorio compartido", default=DEFAULT_DIR)
+  parser.add_option(
+      "-m", "--mode", type="choice", choices=list(SERVE_MODES),
+      help="Modo de atención de clientes: %s" % ", ".join(SERVE_MODES),
+      default=DEFAULT_MODE)
+  parser.add_option(
+      "-b", "--backlog", type="int",
+      help="Conexiones pendientes de aceptar", default=LISTEN_BACKLOG)
+  parser.add_option(
+      "--min-workers", type="int",
+      help="Hilos mínimos del pool (modo threads)", default=MIN_WORKERS)
+  parser.add_option(
+      "--max-workers", type="int",
+      help="Hilos máximos del pool (modo threads)", default=MAX_WORKERS)
+  parser.add_option(
+      "--max-queued", type="int",
+      help="Conexiones en espera de un hilo antes de rechazar",
+      default=MAX_QUEUED)
+  parser.add_option(
+      "--queue-timeout", type="float",
+      help="Segundos máximos de espera de una conexión por un hilo",
+      default=QUEUE_TIMEOUT)
+  parser.add_option(
+      "--stat-ttl", type="float",
+      help="Segundos de validez de los metadatos cacheados sin inotify",
+      default=STAT_CACHE_TTL)
+  parser.add_option(
+      "--idle-timeout", type="float",
+      help="Segundos que una conexión puede estar sin enviar pedidos",
+      default=IDLE_TIMEOUT)
+  parser.add_option(
+      "--command-timeout", type="float",
+      help="Segundos para completar un pedido o aceptar cada parte de "
+      "una respuesta", default=COMMAND_TIMEOUT)
+  parser.add_option(
+      "--rate", type="float",
+      help="Bytes por segundo de todas las descargas juntas (0: sin límite; "
+      "con -w, se reparte entre los workers)", default=0)
+  parser.add_option(
+      "--connection-rate", type="float",
+      help="Bytes por segundo de las descargas de cada conexión "
+      "(0: sin límite)", default=0)
+  parser.add_option(
+      "--nodelay", action="store_true",
+      help="Desactiva el algoritmo de Nagle en las conexiones (TCP_NODELAY)",
+      default=False)
+  parser.add_option(
+      "--metrics-port", type="int",
+      help="Puerto local de las métricas para Prometheus (0: desactivado; "
+      "con -w, cada worker usa el siguiente)", default=0)
+  parser.add_option(
+      "--profile-dir",
+      help="Directorio donde guardar los perfiles pedidos con SIGUSR1",
+      default=tempfile.gettempdir())
+  parser.add_option(
+      "-w", "--workers",
+      help="Cantidad de procesos que atienden clientes (0: un solo proceso)",
+      default=0)
 
   options, args = parser.parse_args()
   if len(args) > 0:
@@ -111,9 +682,35 @@ def main():
         "Numero de puerto invalido: %s\n" % repr(options.port))
     parser.print_help()
     sys.exit(1)
+  try:
+    workers = int(options.workers)
+  except ValueError:
+    workers = -1
+  if workers < 0:
+    sys.stderr.write(
+        "Cantidad de workers invalida: %s\n" % repr(options.workers))
+    parser.print_help()
+    sys.exit(1)
+  if workers > 0 and not hasattr(socket, "SO_REUSEPORT"):
+    sys.stderr.write("SO_REUSEPORT no está disponible en este sistema\n")
+    sys.exit(1)
+
+  if not 0 < options.min_workers <= options.max_workers:
+    sys.stderr.write("Se requiere 0 < min-workers <= max-workers\n")
+    parser.print_help()
+    sys.exit(1)
 
-  server = Server(options.address, port, options.datadir)
-  server.serve()
+  server = Server(options.address, port, options.datadir, options.backlog,
+                  options.min_workers, options.max_workers,
+                  options.max_queued, options.queue_timeout,
+                  options.stat_ttl, options.nodelay, options.metrics_port,
+                  options.profile_dir, options.idle_timeout,
+                  options.command_timeout, options.rate,
+                  options.connection_rate)
+  if workers > 0:
+    server.serve_workers(workers, options.mode)
+  else:
+    server.run(options.mode)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+# encoding: utf-8
+# Limitación del ancho de banda de las descargas, global y por conexión,
+# con baldes de fichas (token buckets).
+
+import time
+import threading
+from constants import *
+
+
+class TokenBucket(object):
+  """
+  Balde que se llena a `rate' bytes por segundo, hasta `burst' bytes.
+  Quien envía reserva los bytes antes de enviarlos: el saldo puede
+  quedar negativo, y los siguientes esperan a que se recupere. Así las
+  reservas se atienden en orden de llegada.
+  """
+
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    if burst is None:
+      burst = max(rate * SHAPE_BURST_SECONDS, SHAPE_BLOCK_SIZE)
+    self.burst = burst
+    self.tokens = burst
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def reserve(self, size):
+    """
+    Descuenta `size' bytes y devuelve los segundos que hay que esperar
+    antes de enviarlos (0 si hay saldo).
+    """
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      self.tokens -= size
+      if self.tokens >= 0:
+        return 0
+      return -self.tokens / self.rate
+
+
+class Shaper(object):
+  """
+  Límites de ancho de banda del servidor: uno global, compartido por
+  todas las conexiones, y uno para cada conexión. Una tasa 0 no limita.
+  """
+
+  def __init__(self, rate=0, connection_rate=0):
+    self.configure(rate, connection_rate)
+
+  def configure(self, rate, connection_rate):
+    self.rate = rate
+    self.connection_rate = connection_rate
+    self.bucket = TokenBucket(rate) if rate else None
+
+  def enabled(self):
+    return bool(self.rate or self.connection_rate)
+
+  def connection_bucket(self):
+    """
+    Balde propio de una conexión nueva; None si no hay límite.
+    """
+    if self.connection_rate:
+      return TokenBucket(self.connection_rate)
+    return None
+
+  def reserve(self, bucket, size):
+    """
+    Reserva `size' bytes en el balde de la conexión y en el global, y
+    devuelve los segundos que hay que esperar antes de enviarlos.
+    """
+    delay = 0
+    if bucket is not None:
+      delay = bucket.reserve(size)
+    if self.bucket is not None:
+      delay = max(delay, self.bucket.reserve(size))
+    return delay